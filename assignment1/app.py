@@ -1,14 +1,20 @@
 import json
+import os
 from tkinter import X
 
+import cache
+import journal
+import store
+
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
 
 app = Flask(__name__)
 
-# This pre-populates dictionary for testing purposes
-posts = {
+# This pre-populates the board for testing purposes
+seed_posts = {
     0: {"id": 0,
         "upvotes": 1,
         "title": "My cat is the cutest!",
@@ -22,7 +28,7 @@ posts = {
         "username": "alicia98"}
 }
 
-comments = {
+seed_comments = {
     0: {
         2: {
             "id": 2,
@@ -51,8 +57,39 @@ comments = {
         }}
 }
 
-# Keep track of the next id
-id_counter = 6
+# Set BOARD_DIR to keep the board on disk across restarts
+if os.environ.get("BOARD_DIR"):
+    JOURNAL = journal.Journal(os.environ["BOARD_DIR"])
+    BOARD = store.Board(journal=JOURNAL)
+    BOARD.recover()
+    seed = JOURNAL.is_new
+else:
+    BOARD = store.Board()
+    seed = True
+
+if seed:
+    for post in seed_posts.values():
+        BOARD.insert_post(store.Post(**post))
+    for pid, post_comments in seed_comments.items():
+        for comment in post_comments.values():
+            BOARD.insert_comment(pid, store.Comment(**comment))
+
+# Set RESPONSE_CACHE=0 to encode every response from scratch, and
+# RESPONSE_CACHE_MB to bound the memory cached bodies take
+CACHE = cache.ResponseCache(
+    os.environ.get("RESPONSE_CACHE", "1") != "0",
+    int(os.environ.get("RESPONSE_CACHE_MB", "64")) << 20)
+
+
+def cached_response(entry):
+    """
+    Send a cached (body, etag), or 304 if the client already has it
+    """
+    body, etag = entry
+    headers = {"ETag": '"%s"' % etag}
+    if request.if_none_match.contains(etag):
+        return "", 304, headers
+    return body, 200, headers
 
 
 @ app.route("/")
@@ -66,10 +103,178 @@ def hello_world():
 @ app.route("/posts/")
 def get_all_posts():
     """
-    Return all posts in server
+    Return posts in server, sorted by `sort` ("id" or "upvotes").
+    Pass `limit` to page through them and `after` with the "next" cursor
+    of the previous page to continue.
+    """
+    sort = request.args.get("sort", "id")
+    if sort not in ("id", "upvotes"):
+        return json.dumps({"error": "Sort must be id or upvotes!"}), 400
+
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return json.dumps({"error": "Limit must be positive!"}), 400
+
+    after = request.args.get("after")
+    entry = CACHE.get("posts", (sort, after, limit))
+    if entry is not None:
+        return cached_response(entry)
+
+    generation = CACHE.generation("posts")
+    try:
+        page, next_cursor = BOARD.list_posts(sort, after, limit)
+    except ValueError:
+        return json.dumps({"error": "Invalid cursor!"}), 400
+
+    res = {
+        "posts": [BOARD.serialize_post(post) for post in page]
+    }
+    if next_cursor is not None:
+        res["next"] = next_cursor
+    return cached_response(
+        CACHE.put("posts", (sort, after, limit), generation, json.dumps(res)))
+
+
+def parse_items(data):
+    """
+    Parse a request body holding either a JSON array or one JSON value
+    per line (NDJSON). Items that fail to parse come back as None.
+    """
+    text = data.decode("utf-8").strip()
+    if text.startswith("["):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return [None]
+
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+def stream_results(results):
+    """
+    Stream one JSON line per item of a bulk request
+    """
+    def generate():
+        for index, result in enumerate(results):
+            result["index"] = index
+            yield json.dumps(result) + "\n"
+
+    return Response(generate(), 200, mimetype="application/x-ndjson")
+
+
+@ app.route("/posts/bulk/", methods=["POST"])
+def create_posts():
+    """
+    Create many posts from a JSON array or NDJSON body. A post may carry a
+    "comments" list to create along with it. Streams back one result line
+    per post.
+    """
+    items = parse_items(request.data)
+    valid = [item for item in items if isinstance(item, dict)]
+    posts = iter(BOARD.create_posts([
+        (item.get("title"), item.get("link"), item.get("username"))
+        for item in valid
+    ]))
+
+    results = []
+    touched = ["posts"]
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"status": 400, "error": "Invalid post!"})
+            continue
+
+        post = next(posts)
+        result = {"status": 201, "post": BOARD.serialize_post(post)}
+        item_comments = item.get("comments")
+        if isinstance(item_comments, list) and item_comments:
+            comments = BOARD.create_comments(post.id, [
+                (c.get("text"), c.get("username"))
+                for c in item_comments if isinstance(c, dict)
+            ])
+            result["comments"] = [c.serialize() for c in comments]
+            touched.append(("comments", post.id))
+        results.append(result)
+
+    CACHE.invalidate(*touched)
+    return stream_results(results)
+
+
+@ app.route("/posts/bulk/", methods=["DELETE"])
+def delete_posts():
+    """
+    Delete many posts by id, given as a JSON array or NDJSON body. Streams
+    back one result line per id.
+    """
+    results = []
+    touched = ["posts"]
+    for pid in parse_items(request.data):
+        # JSON true and false come back as ints, but are not ids
+        post = None
+        if isinstance(pid, int) and not isinstance(pid, bool):
+            post = BOARD.delete_post(pid)
+        if post is None:
+            results.append({"status": 404, "error": "Post not found!"})
+            continue
+        results.append({"status": 200, "post": BOARD.serialize_post(post)})
+        touched.extend([("post", pid), ("comments", pid)])
+
+    CACHE.invalidate(*touched)
+    return stream_results(results)
+
+
+@ app.route("/posts/<int:pid>/comments/bulk/", methods=["POST"])
+def create_comments(pid):
+    """
+    Create many comments on a post from a JSON array or NDJSON body.
+    Streams back one result line per comment.
+    """
+    items = parse_items(request.data)
+    comments = BOARD.create_comments(pid, [
+        (item.get("text"), item.get("username"))
+        for item in items if isinstance(item, dict)
+    ])
+    if comments is None:
+        return json.dumps({"error": "Post not found!"}), 404
+
+    CACHE.invalidate(("comments", pid))
+    comments = iter(comments)
+    results = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({"status": 400, "error": "Invalid comment!"})
+            continue
+        results.append({"status": 201, "comment": next(comments).serialize()})
+    return stream_results(results)
+
+
+@ app.route("/posts/search/", strict_slashes=False)
+def search_posts():
+    """
+    Search post titles and comment texts for the words in `q`. Returns up
+    to `limit` of each, best matches first and then most upvoted.
     """
+    query = request.args.get("q", "")
+    limit = request.args.get("limit", 20, type=int)
+    if limit <= 0:
+        return json.dumps({"error": "Limit must be positive!"}), 400
+
     res = {
-        "posts": list(posts.values())
+        "posts": [
+            BOARD.serialize_post(post)
+            for post in BOARD.search_posts(query, limit)
+        ],
+        "comments": [
+            dict(BOARD.serialize_comment(pid, comment), post_id=pid)
+            for pid, comment in BOARD.search_comments(query, limit)
+        ]
     }
     return json.dumps(res), 200
 
@@ -79,26 +284,15 @@ def create_post():
     """
     Create a post
     """
-    global id_counter
-
     # Get all needed data from request
     body = json.loads(request.data)
     title = body.get("title")
     link = body.get("link")
     username = body.get("username")
 
-    # Put all data into a dictionary that contains all info of the post
-    post = {
-        "id": id_counter,
-        "upvotes": 0,
-        "title": title,
-        "link": link,
-        "username": username
-    }
-
-    posts[id_counter] = post
-    id_counter += 1
-    return json.dumps(post), 201
+    post = BOARD.create_post(title, link, username)
+    CACHE.invalidate("posts")
+    return json.dumps(BOARD.serialize_post(post)), 201
 
 
 @app.route("/posts/<int:pid>/")
@@ -106,11 +300,18 @@ def get_post(pid):
     """
     Get post by id
     """
-    post = posts.get(pid)
+    entry = CACHE.get(("post", pid))
+    if entry is not None:
+        return cached_response(entry)
+
+    generation = CACHE.generation(("post", pid))
+    post = BOARD.get_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found!"}), 404
 
-    return json.dumps(post), 200
+    return cached_response(CACHE.put(
+        ("post", pid), None, generation,
+        json.dumps(BOARD.serialize_post(post))))
 
 
 @app.route("/posts/<int:pid>/", methods=["DELETE"])
@@ -118,28 +319,75 @@ def delete_post(pid):
     """
     Delete post by id
     """
-    post = posts.get(pid)
-
+    post = BOARD.delete_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found!"}), 404
 
-    del posts[pid]
-    return json.dumps(post), 200
+    CACHE.invalidate("posts", ("post", pid), ("comments", pid))
+    return json.dumps(BOARD.serialize_post(post)), 200
 
 
 @ app.route("/posts/<int:pid>/comments/")
 def get_all_comments(pid):
     """
-    Return all comments of a specific post
+    Return all comments of a specific post, most upvoted first if `sort`
+    is "upvotes". Pass `stream` as "ndjson" or "json" to have them sent
+    one at a time instead of encoded in one piece.
     """
-    post = posts.get(pid)
-    if post is None:
+    sort = request.args.get("sort", "id")
+    if sort not in ("id", "upvotes"):
+        return json.dumps({"error": "Sort must be id or upvotes!"}), 400
+
+    stream = request.args.get("stream")
+    if stream not in (None, "ndjson", "json"):
+        return json.dumps({"error": "Stream must be ndjson or json!"}), 400
+
+    if stream is None:
+        entry = CACHE.get(("comments", pid), sort)
+        if entry is not None:
+            return cached_response(entry)
+        generation = CACHE.generation(("comments", pid))
+
+    if sort == "upvotes":
+        post_comments = BOARD.sorted_comments(pid)
+    else:
+        post_comments = BOARD.get_comments(pid)
+    if post_comments is None:
         return json.dumps({"error": "Post not found!"}), 404
 
+    if stream is not None:
+        return stream_comments(pid, post_comments, stream)
+
     res = {
-        "comments": list(comments[pid].values())
+        "comments": [
+            BOARD.serialize_comment(pid, comment) for comment in post_comments
+        ]
     }
-    return json.dumps(res), 200
+    return cached_response(
+        CACHE.put(("comments", pid), sort, generation, json.dumps(res)))
+
+
+def stream_comments(pid, post_comments, stream):
+    """
+    Stream comments one at a time, either one per line ("ndjson") or as
+    the same document get_all_comments sends ("json")
+    """
+    def generate_ndjson():
+        for comment in post_comments:
+            yield json.dumps(BOARD.serialize_comment(pid, comment)) + "\n"
+
+    def generate_json():
+        yield '{"comments": ['
+        separator = ""
+        for comment in post_comments:
+            yield separator + json.dumps(BOARD.serialize_comment(pid, comment))
+            separator = ", "
+        yield "]}"
+
+    if stream == "ndjson":
+        return Response(generate_ndjson(), 200,
+                        mimetype="application/x-ndjson")
+    return Response(generate_json(), 200, mimetype="application/json")
 
 
 @ app.route("/posts/<int:pid>/comments/", methods=["POST"])
@@ -149,26 +397,16 @@ def create_comment(pid):
     """
 
     # Get data from request
-    global id_counter
     body = json.loads(request.data)
     text = body.get("text")
     username = body.get("username")
 
-    # Put all data into a dictionary that contains all info of the comment
-    comment = {
-        "id": id_counter,
-        "upvotes": 0,
-        "text": text,
-        "username": username
-    }
-
-    post = posts.get(pid)
-    if post is None:
+    comment = BOARD.create_comment(pid, text, username)
+    if comment is None:
         return json.dumps({"error": "Post not found!"}), 404
 
-    comments[pid][id_counter] = comment
-    id_counter += 1
-    return json.dumps(comment), 201
+    CACHE.invalidate(("comments", pid))
+    return json.dumps(BOARD.serialize_comment(pid, comment)), 201
 
 
 @ app.route("/posts/<int:pid>/comments/<int:cid>/", methods=["POST"])
@@ -176,19 +414,48 @@ def edit_comment(pid, cid):
     """
     Edit a comment by comment and post id
     """
-    post = posts.get(pid)
+    post = BOARD.get_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found!"}), 404
 
-    comment = comments.get(pid).get(cid)
-    if comment is None:
-        return json.dumps({"error": "Comment not found!"}), 404
-
     # Get updates from request
     body = json.loads(request.data)
     text = body.get("text")
-    comment["text"] = text
-    return json.dumps(comment), 200
+    comment = BOARD.edit_comment(pid, cid, text)
+    if comment is None:
+        return json.dumps({"error": "Comment not found!"}), 404
+
+    CACHE.invalidate(("comments", pid))
+    return json.dumps(BOARD.serialize_comment(pid, comment)), 200
+
+
+@ app.route("/posts/<int:pid>/upvote/", methods=["POST"])
+def upvote_post(pid):
+    """
+    Upvote a post by id
+    """
+    post = BOARD.upvote_post(pid)
+    if post is None:
+        return json.dumps({"error": "Post not found!"}), 404
+
+    CACHE.invalidate("posts", ("post", pid))
+    return json.dumps(BOARD.serialize_post(post)), 200
+
+
+@ app.route("/posts/<int:pid>/comments/<int:cid>/upvote/", methods=["POST"])
+def upvote_comment(pid, cid):
+    """
+    Upvote a comment by comment and post id
+    """
+    if BOARD.get_post(pid) is None:
+        return json.dumps({"error": "Post not found!"}), 404
+
+    comment = BOARD.upvote_comment(pid, cid)
+    if comment is None:
+        return json.dumps({"error": "Comment not found!"}), 404
+
+    CACHE.invalidate(("comments", pid))
+    return json.dumps(BOARD.serialize_comment(pid, comment)), 200
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import hashlib
+import threading
+
+
+class ResponseCache(object):
+    """
+    Encoded response bodies kept per resource along with their ETags, so
+    an unchanged resource is only encoded once. A resource is a group
+    such as ("post", 3) and may be cached in several variants, e.g. one
+    per page of a listing. Bodies are dropped least recently used first
+    once they take up more than `max_bytes`, and only the `max_variants`
+    most recently used variants of a resource are kept, since clients
+    pick the variants.
+    """
+
+    def __init__(self, enabled=True, max_bytes=64 << 20, max_variants=64,
+                 max_invalidated=65536):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.max_variants = max_variants
+        self.max_invalidated = max_invalidated
+        # (group, variant) -> (body, etag), least recently used first
+        self.entries = OrderedDict()
+        # group -> its cached variants, least recently used first
+        self.groups = {}
+        self.size = 0
+        # Counts invalidations. A body may only be cached if its resource
+        # has not been invalidated since the clock was read for it, i.e.
+        # since max(floor, invalidated[group]).
+        self.clock = 0
+        self.invalidated = {}
+        self.floor = 0
+        self.lock = threading.Lock()
+
+    def get(self, group, variant=None):
+        """
+        Get the cached (body, etag) of a resource, or None on a miss
+        """
+        key = (group, variant)
+        entry = self.entries.get(key)
+        if entry is not None:
+            try:
+                self.entries.move_to_end(key)
+                self.groups[group].move_to_end(variant)
+            except KeyError:
+                # Evicted by a `put` meanwhile, which is fine for a hit
+                pass
+        return entry
+
+    def generation(self, group):
+        """
+        Get the generation to hand to `put` for a resource. Read it before
+        reading the data a body is built from.
+        """
+        return self.clock
+
+    def put(self, group, variant, generation, body):
+        """
+        Encode `body` and cache it, unless the resource was invalidated
+        since `generation` was read. Returns the (body, etag) either way.
+        """
+        body = body.encode("utf-8")
+        entry = (body, hashlib.blake2b(body, digest_size=12).hexdigest())
+        if not self.enabled or len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            if generation < max(self.floor, self.invalidated.get(group, 0)):
+                return entry
+            key = (group, variant)
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = entry
+            variants = self.groups.setdefault(group, OrderedDict())
+            variants[variant] = None
+            self.size += len(body)
+            if len(variants) > self.max_variants:
+                self.drop((group, next(iter(variants))))
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+        return entry
+
+    def drop(self, key):
+        """
+        Remove one cached body. Call with the lock held.
+        """
+        body, _ = self.entries.pop(key)
+        self.size -= len(body)
+        group, variant = key
+        variants = self.groups[group]
+        del variants[variant]
+        if not variants:
+            del self.groups[group]
+
+    def invalidate(self, *groups):
+        """
+        Drop every cached variant of the given resources
+        """
+        with self.lock:
+            self.clock += 1
+            for group in groups:
+                self.invalidated[group] = self.clock
+                for variant in list(self.groups.get(group, ())):
+                    self.drop((group, variant))
+            if len(self.invalidated) > self.max_invalidated:
+                # Forget which resources were invalidated when. Bodies
+                # read before now can no longer be told apart, so none
+                # of them are cached.
+                self.floor = self.clock
+                self.invalidated.clear()
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Reused for every record, since json.dumps builds a new encoder whenever
+# it is passed options
+ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    Append-only log of changes to the board plus periodic snapshots, so
+    the board survives a restart. Every record sets state rather than
+    changing it (e.g. "this post now exists"), so replaying a record that
+    a snapshot already covers is harmless.
+    """
+
+    def __init__(self, directory, sync_interval=0.05, snapshot_every=100000):
+        """
+        Open the journal kept in `directory`. Appended records are flushed
+        and fsynced in batches at most `sync_interval` seconds apart, and a
+        snapshot is taken once `snapshot_every` records have been appended.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, "board.log")
+        self.old_log_path = self.log_path + ".old"
+        self.snapshot_path = os.path.join(directory, "board.snapshot")
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+
+        self.is_new = not any(os.path.exists(p) for p in (
+            self.log_path, self.old_log_path, self.snapshot_path))
+        self.lock = threading.Lock()
+        self.file = open(self.log_path, "a")
+        self.pending = 0
+        self.appended = 0
+        self.take_snapshot = None
+        self.before_sync = None
+        self.snapshotting = threading.Lock()
+
+    def start(self, take_snapshot, before_sync=None):
+        """
+        Start the background thread that syncs the log and calls
+        `take_snapshot` when the log has grown large enough. `before_sync`
+        is called ahead of every sync to log any changes held back.
+        """
+        self.take_snapshot = take_snapshot
+        self.before_sync = before_sync
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        """
+        Background loop for syncing the log and taking snapshots
+        """
+        while True:
+            time.sleep(self.sync_interval)
+            # A failed round is retried on the next one rather than ending
+            # syncing for good
+            try:
+                if self.before_sync is not None:
+                    self.before_sync()
+                self.sync()
+                if (self.appended >= self.snapshot_every
+                        and self.snapshotting.acquire(blocking=False)):
+                    threading.Thread(
+                        target=self.snapshot, daemon=True).start()
+            except Exception:
+                log.exception("Syncing the journal failed")
+
+    def snapshot(self):
+        """
+        Take a snapshot off the sync thread, so syncing carries on meanwhile
+        """
+        try:
+            self.take_snapshot()
+        except Exception:
+            log.exception("Taking a snapshot failed")
+        finally:
+            self.snapshotting.release()
+
+    def append(self, record):
+        """
+        Add a record to the log. The caller should hold the lock guarding
+        the data the record describes, so the log keeps the same order as
+        the board.
+        """
+        line = ENCODER.encode(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.pending += 1
+            self.appended += 1
+
+    def append_many(self, records):
+        """
+        Add several records to the log in one write
+        """
+        lines = "".join(ENCODER.encode(record) + "\n" for record in records)
+        with self.lock:
+            self.file.write(lines)
+            self.pending += len(records)
+            self.appended += len(records)
+
+    def sync(self):
+        """
+        Make every appended record durable
+        """
+        with self.lock:
+            if self.pending == 0:
+                return
+            self.file.flush()
+            self.pending = 0
+            # fsync a copy of the descriptor, since `rotate` may close the
+            # file once the lock is released
+            fd = os.dup(self.file.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rotate(self):
+        """
+        Move the current log aside and start a new one. Records appended
+        after this belong to the next snapshot's tail.
+        """
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if os.path.exists(self.old_log_path):
+                # An earlier snapshot never finished, so its log is still
+                # needed and this one goes after it
+                with open(self.old_log_path, "a") as old, \
+                        open(self.log_path) as new:
+                    old.write(new.read())
+                    old.flush()
+                    os.fsync(old.fileno())
+                os.remove(self.log_path)
+            else:
+                os.replace(self.log_path, self.old_log_path)
+            self.file = open(self.log_path, "a")
+            self.pending = 0
+            self.appended = 0
+
+    def write_snapshot(self, state):
+        """
+        Atomically replace the snapshot with `state`, then drop the log
+        that was moved aside by `rotate`
+        """
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.old_log_path):
+            os.remove(self.old_log_path)
+
+    def read_snapshot(self):
+        """
+        Get the state saved by the last snapshot, or None if there is none
+        """
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path) as f:
+            return json.load(f)
+
+    def records(self):
+        """
+        Yield the records logged since the last snapshot, in order. A torn
+        last line left behind by a crash is cut off the log, so records
+        appended from now on start on a line of their own.
+        """
+        for path in (self.old_log_path, self.log_path):
+            if not os.path.exists(path):
+                continue
+            end = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    end += len(line)
+                    yield json.loads(line)
+            if end < os.path.getsize(path):
+                os.truncate(path, end)
@@ -0,0 +1,79 @@
+import heapq
+import re
+import threading
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    Split text into lowercase words
+    """
+    if not isinstance(text, str):
+        return []
+    return WORD.findall(text.lower())
+
+
+class SearchIndex(object):
+    """
+    Inverted index from each word to the documents containing it and how
+    often it appears in each. Documents are identified by any hashable
+    key, e.g. a post id.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    def add(self, doc, text):
+        """
+        Index the words of `text` under `doc`
+        """
+        words = tokenize(text)
+        with self.lock:
+            for word in words:
+                docs = self.postings.get(word)
+                if docs is None:
+                    docs = self.postings[word] = {}
+                docs[doc] = docs.get(doc, 0) + 1
+
+    def remove(self, doc, text):
+        """
+        Drop `doc`, which was indexed with `text`
+        """
+        words = set(tokenize(text))
+        with self.lock:
+            for word in words:
+                docs = self.postings.get(word)
+                if docs is None:
+                    continue
+                docs.pop(doc, None)
+                if not docs:
+                    del self.postings[word]
+
+    def search(self, query, limit, tiebreak):
+        """
+        Get up to `limit` documents containing every word of `query`, most
+        frequent matches first. Equal matches are ordered by
+        `tiebreak(doc)`, highest first.
+        """
+        words = set(tokenize(query))
+        if not words:
+            return []
+        with self.lock:
+            lists = [self.postings.get(word) for word in words]
+            if any(docs is None for docs in lists):
+                return []
+            # Walk the rarest word's documents and look the rest up
+            lists.sort(key=len)
+            scores = {}
+            for doc, count in lists[0].items():
+                for docs in lists[1:]:
+                    other = docs.get(doc)
+                    if other is None:
+                        break
+                    count += other
+                else:
+                    scores[doc] = count
+        return heapq.nlargest(
+            limit, scores, key=lambda doc: (scores[doc], tiebreak(doc)))
@@ -0,0 +1,636 @@
+import itertools
+import sys
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from search import SearchIndex
+
+
+def intern_name(username):
+    """
+    Share one copy of each username between all records that use it
+    """
+    if isinstance(username, str):
+        return sys.intern(username)
+    return username
+
+
+class Post(object):
+    """
+    A post on the forum. Slotted so a post only pays for its five fields
+    instead of a dictionary repeating the key names.
+    """
+    __slots__ = ("id", "upvotes", "title", "link", "username")
+
+    def __init__(self, id, upvotes, title, link, username):
+        self.id = id
+        self.upvotes = upvotes
+        self.title = title
+        self.link = link
+        self.username = intern_name(username)
+
+    def serialize(self, votes=0):
+        """
+        Serializes the post in the same form as the API has always used,
+        counting `votes` not yet added to `upvotes`
+        """
+        return {
+            "id": self.id,
+            "upvotes": self.upvotes + votes,
+            "title": self.title,
+            "link": self.link,
+            "username": self.username
+        }
+
+    def row(self, votes=0):
+        """
+        Get the fields as a list, for compact storage in the journal
+        """
+        return [self.id, self.upvotes + votes, self.title, self.link,
+                self.username]
+
+
+class Comment(object):
+    """
+    A comment on a post, slotted like Post
+    """
+    __slots__ = ("id", "upvotes", "text", "username")
+
+    def __init__(self, id, upvotes, text, username):
+        self.id = id
+        self.upvotes = upvotes
+        self.text = text
+        self.username = intern_name(username)
+
+    def serialize(self, votes=0):
+        """
+        Serializes the comment in the same form as the API has always used,
+        counting `votes` not yet added to `upvotes`
+        """
+        return {
+            "id": self.id,
+            "upvotes": self.upvotes + votes,
+            "text": self.text,
+            "username": self.username
+        }
+
+    def row(self, votes=0):
+        """
+        Get the fields as a list, for compact storage in the journal
+        """
+        return [self.id, self.upvotes + votes, self.text, self.username]
+
+
+class VoteCounter(object):
+    """
+    Upvote counts split over shards, each with its own lock. Every thread
+    sticks to one shard, so threads voting on the same post rarely wait on
+    each other. A count is the sum of its shards.
+    """
+
+    def __init__(self, shards=16):
+        self.counts = [{} for _ in range(shards)]
+        self.changes = [set() for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.local = threading.local()
+        self.next_shard = itertools.count()
+
+    def shard(self):
+        """
+        Get the shard used by the current thread
+        """
+        index = getattr(self.local, "index", None)
+        if index is None:
+            index = next(self.next_shard) % len(self.counts)
+            self.local.index = index
+        return index
+
+    def add(self, key, amount=1):
+        """
+        Add `amount` votes to `key`
+        """
+        index = self.shard()
+        counts = self.counts[index]
+        with self.locks[index]:
+            counts[key] = counts.get(key, 0) + amount
+            self.changes[index].add(key)
+
+    def get(self, key):
+        """
+        Get the number of votes for `key`
+        """
+        return sum(counts.get(key, 0) for counts in self.counts)
+
+    def discard(self, key):
+        """
+        Forget the votes for `key`
+        """
+        for counts, lock in zip(self.counts, self.locks):
+            with lock:
+                counts.pop(key, None)
+
+    def changed(self):
+        """
+        Get the keys voted on since the last call
+        """
+        keys = set()
+        for index, lock in enumerate(self.locks):
+            with lock:
+                changes = self.changes[index]
+                self.changes[index] = set()
+            keys |= changes
+        return keys
+
+
+class Board(object):
+    """
+    In-memory store for the posts and comments of the forum.
+    Safe to share between the threads of a threaded server.
+    """
+
+    def __init__(self, stripes=64, journal=None):
+        """
+        Create an empty board. Comments are guarded by `stripes` locks
+        picked by post id, so writes to different posts rarely contend.
+        Changes are recorded in `journal` if one is given.
+        """
+        self.journal = journal
+        self.posts = {}
+        self.comments = {}
+        self.next_id = 0
+
+        # Sorted indexes over posts so a page can be found with a binary
+        # search instead of listing the whole dictionary. The ranking index
+        # holds (-upvotes, id) so that ascending order is most upvoted first.
+        self.post_ids = []
+        self.post_ranking = []
+
+        # Votes are kept apart from the records they count. `ranked` holds
+        # the upvotes a post is filed under in the ranking index, for posts
+        # voted on since they were inserted.
+        self.votes = VoteCounter()
+        self.ranked = {}
+
+        # Full-text indexes over post titles and comment texts. Comments
+        # are keyed by (post id, comment id).
+        self.titles = SearchIndex()
+        self.texts = SearchIndex()
+
+        self.id_lock = threading.Lock()
+        self.posts_lock = threading.Lock()
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+
+    def log(self, record):
+        """
+        Record a change in the journal, if there is one
+        """
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def log_many(self, records):
+        """
+        Record several changes in the journal, if there is one
+        """
+        if self.journal is not None:
+            self.journal.append_many(records)
+
+    def recover(self):
+        """
+        Rebuild the board from the journal's snapshot and log, then start
+        journaling new changes
+        """
+        journal = self.journal
+        self.journal = None
+        state = journal.read_snapshot()
+        if state is not None:
+            self.load(state)
+        for record in journal.records():
+            self.apply(record)
+        self.journal = journal
+        journal.start(self.snapshot, self.refresh_votes)
+
+    def load(self, state):
+        """
+        Replace the contents of the board with a snapshot's state, building
+        the indexes with one sort instead of an insert per post
+        """
+        with self.posts_lock:
+            self.posts = {row[0]: Post(*row) for row in state["posts"]}
+            self.comments = {
+                pid: {row[0]: Comment(*row) for row in rows}
+                for pid, rows in state["comments"]
+            }
+            self.post_ids = sorted(self.posts)
+            self.post_ranking = sorted(
+                (-post.upvotes, post.id) for post in self.posts.values())
+            self.votes = VoteCounter()
+            self.ranked = {}
+            self.titles = SearchIndex()
+            self.texts = SearchIndex()
+            for post in self.posts.values():
+                self.titles.add(post.id, post.title)
+            for pid, post_comments in self.comments.items():
+                for comment in post_comments.values():
+                    self.texts.add((pid, comment.id), comment.text)
+        self.reserve_id(state["next_id"] - 1)
+
+    def apply(self, record):
+        """
+        Replay a single journal record
+        """
+        op = record[0]
+        if op == "post":
+            self.insert_post(Post(*record[1]))
+        elif op == "comment":
+            self.insert_comment(record[1], Comment(*record[2]))
+        elif op == "delete":
+            self.delete_post(record[1])
+        elif op == "edit":
+            self.edit_comment(record[1], record[2], record[3])
+        elif op == "upvotes":
+            self.set_post_upvotes(record[1], record[2])
+        elif op == "comment_upvotes":
+            self.set_comment_upvotes(record[1], record[2], record[3])
+
+    def snapshot(self):
+        """
+        Write the whole board to the journal's snapshot so the log can
+        start over
+        """
+        self.journal.rotate()
+        next_id = self.next_id
+        with self.posts_lock:
+            posts = list(self.posts.values())
+        comments = []
+        for post in posts:
+            post_comments = self.get_comments(post.id)
+            if post_comments is not None:
+                comments.append([post.id, [
+                    c.row(self.votes.get((post.id, c.id)))
+                    for c in post_comments
+                ]])
+        self.journal.write_snapshot({
+            "next_id": next_id,
+            "posts": [post.row(self.votes.get(post.id)) for post in posts],
+            "comments": comments
+        })
+
+    def stripe(self, pid):
+        """
+        Get the lock guarding the comments of post `pid`
+        """
+        return self.stripes[pid % len(self.stripes)]
+
+    def allocate_ids(self, count=1):
+        """
+        Reserve `count` consecutive ids and return the first one
+        """
+        with self.id_lock:
+            first = self.next_id
+            self.next_id += count
+        return first
+
+    def reserve_id(self, id):
+        """
+        Make sure ids handed out later are greater than `id`
+        """
+        with self.id_lock:
+            self.next_id = max(self.next_id, id + 1)
+
+    def insert_post(self, post):
+        """
+        Add an already built post, keeping its id
+        """
+        self.reserve_id(post.id)
+        with self.stripe(post.id):
+            self.comments.setdefault(post.id, {})
+        with self.posts_lock:
+            if post.id in self.posts:
+                old = self.posts[post.id]
+                self.unrank(old)
+                self.votes.discard(post.id)
+                self.titles.remove(old.id, old.title)
+            else:
+                insort(self.post_ids, post.id)
+            self.posts[post.id] = post
+            self.titles.add(post.id, post.title)
+            insort(self.post_ranking, (-post.upvotes, post.id))
+            self.log(["post", post.row()])
+        return post
+
+    def insert_comment(self, pid, comment):
+        """
+        Add an already built comment to post `pid`, keeping its id.
+        Returns None if the post does not exist.
+        """
+        self.reserve_id(comment.id)
+        with self.stripe(pid):
+            post_comments = self.comments.get(pid)
+            if post_comments is None:
+                return None
+            old = post_comments.get(comment.id)
+            if old is not None:
+                self.texts.remove((pid, old.id), old.text)
+            post_comments[comment.id] = comment
+            self.texts.add((pid, comment.id), comment.text)
+            self.log(["comment", pid, comment.row()])
+        return comment
+
+    def create_post(self, title, link, username):
+        """
+        Create a post with a new id
+        """
+        return self.insert_post(
+            Post(self.allocate_ids(), 0, title, link, username))
+
+    def create_posts(self, fields):
+        """
+        Create a post for each (title, link, username) in `fields`, taking
+        one block of ids and the posts lock once for the whole batch
+        """
+        first = self.allocate_ids(len(fields))
+        posts = [
+            Post(first + i, 0, title, link, username)
+            for i, (title, link, username) in enumerate(fields)
+        ]
+        for post in posts:
+            with self.stripe(post.id):
+                self.comments[post.id] = {}
+        with self.posts_lock:
+            for post in posts:
+                self.posts[post.id] = post
+                insort(self.post_ids, post.id)
+                insort(self.post_ranking, (0, post.id))
+                self.titles.add(post.id, post.title)
+            self.log_many([["post", post.row()] for post in posts])
+        return posts
+
+    def get_post(self, pid):
+        """
+        Get a post by id, or None if it does not exist
+        """
+        return self.posts.get(pid)
+
+    def delete_post(self, pid):
+        """
+        Delete a post and its comments by id. Returns the deleted post,
+        or None if it does not exist.
+        """
+        with self.posts_lock:
+            post = self.posts.pop(pid, None)
+            if post is None:
+                return None
+            del self.post_ids[bisect_left(self.post_ids, pid)]
+            self.unrank(post)
+            self.titles.remove(pid, post.title)
+            self.log(["delete", pid])
+        with self.stripe(pid):
+            post_comments = self.comments.pop(pid, None) or {}
+            for comment in post_comments.values():
+                self.texts.remove((pid, comment.id), comment.text)
+        # The post is unreachable now, so its votes can be folded into it
+        post.upvotes += self.votes.get(pid)
+        self.votes.discard(pid)
+        for cid in post_comments:
+            self.votes.discard((pid, cid))
+        return post
+
+    def unrank(self, post):
+        """
+        Take a post out of the ranking index. The caller holds posts_lock.
+        """
+        upvotes = self.ranked.pop(post.id, post.upvotes)
+        del self.post_ranking[bisect_left(
+            self.post_ranking, (-upvotes, post.id))]
+
+    def upvote_post(self, pid):
+        """
+        Add a vote to post `pid`. Returns the post, or None if it does not
+        exist.
+        """
+        post = self.posts.get(pid)
+        if post is None:
+            return None
+        self.votes.add(pid)
+        return post
+
+    def upvote_comment(self, pid, cid):
+        """
+        Add a vote to comment `cid` of post `pid`. Returns the comment, or
+        None if either does not exist.
+        """
+        comment = self.get_comment(pid, cid)
+        if comment is None:
+            return None
+        self.votes.add((pid, cid))
+        return comment
+
+    def serialize_post(self, post):
+        """
+        Serializes a post with all of its votes counted
+        """
+        return post.serialize(self.votes.get(post.id))
+
+    def serialize_comment(self, pid, comment):
+        """
+        Serializes a comment of post `pid` with all of its votes counted
+        """
+        return comment.serialize(self.votes.get((pid, comment.id)))
+
+    def refresh_votes(self):
+        """
+        Refile posts voted on since the last refresh in the ranking index
+        and journal the new counts of everything voted on
+        """
+        for key in self.votes.changed():
+            if isinstance(key, tuple):
+                pid, cid = key
+                with self.stripe(pid):
+                    comment = self.get_comment(pid, cid)
+                    if comment is not None:
+                        self.log(["comment_upvotes", pid, cid,
+                                  comment.upvotes + self.votes.get(key)])
+                continue
+
+            with self.posts_lock:
+                post = self.posts.get(key)
+                if post is None:
+                    continue
+                upvotes = post.upvotes + self.votes.get(key)
+                if upvotes != self.ranked.get(key, post.upvotes):
+                    self.unrank(post)
+                    insort(self.post_ranking, (-upvotes, key))
+                    self.ranked[key] = upvotes
+                self.log(["upvotes", key, upvotes])
+
+    def set_post_upvotes(self, pid, upvotes):
+        """
+        Set the total upvotes of post `pid`, dropping its separate votes
+        """
+        with self.posts_lock:
+            post = self.posts.get(pid)
+            if post is None:
+                return
+            self.unrank(post)
+            self.votes.discard(pid)
+            post.upvotes = upvotes
+            insort(self.post_ranking, (-upvotes, pid))
+            self.log(["upvotes", pid, upvotes])
+
+    def set_comment_upvotes(self, pid, cid, upvotes):
+        """
+        Set the total upvotes of comment `cid` of post `pid`, dropping its
+        separate votes
+        """
+        with self.stripe(pid):
+            comment = self.get_comment(pid, cid)
+            if comment is None:
+                return
+            self.votes.discard((pid, cid))
+            comment.upvotes = upvotes
+            self.log(["comment_upvotes", pid, cid, upvotes])
+
+    def search_posts(self, query, limit):
+        """
+        Get up to `limit` posts whose titles contain every word of `query`,
+        best matches first and then most upvoted
+        """
+        def upvotes(pid):
+            post = self.posts.get(pid)
+            return 0 if post is None else post.upvotes + self.votes.get(pid)
+
+        pids = self.titles.search(query, limit, upvotes)
+        return [self.posts[pid] for pid in pids if pid in self.posts]
+
+    def search_comments(self, query, limit):
+        """
+        Get up to `limit` (post id, comment) pairs for comments whose texts
+        contain every word of `query`, best matches first and then most
+        upvoted
+        """
+        def upvotes(key):
+            comment = self.get_comment(*key)
+            if comment is None:
+                return 0
+            return comment.upvotes + self.votes.get(key)
+
+        found = []
+        for pid, cid in self.texts.search(query, limit, upvotes):
+            comment = self.get_comment(pid, cid)
+            if comment is not None:
+                found.append((pid, comment))
+        return found
+
+    def list_posts(self, sort="id", after=None, limit=None):
+        """
+        Get a page of posts sorted by `sort` ("id" or "upvotes") along with
+        the cursor of the next page, which is None on the last page.
+        Cursors are "<id>" for id order and "<upvotes>:<id>" for upvotes
+        order. Raises ValueError for a malformed cursor.
+        """
+        if sort == "id":
+            key = None if after is None else int(after)
+        elif after is not None:
+            upvotes, pid = after.split(":")
+            key = (-int(upvotes), int(pid))
+        if sort == "upvotes":
+            self.refresh_votes()
+
+        with self.posts_lock:
+            index = self.post_ids if sort == "id" else self.post_ranking
+            start = 0 if after is None else bisect_right(index, key)
+            end = len(index) if limit is None else start + limit
+            keys = index[start:end]
+            more = end < len(index)
+            ids = keys if sort == "id" else [k[1] for k in keys]
+            page = [self.posts[pid] for pid in ids]
+
+        if limit is None or not more:
+            return page, None
+        if sort == "id":
+            return page, str(keys[-1])
+        return page, "%d:%d" % (-keys[-1][0], keys[-1][1])
+
+    def get_comments(self, pid):
+        """
+        Get all comments of post `pid`, or None if the post does not exist
+        """
+        with self.stripe(pid):
+            post_comments = self.comments.get(pid)
+            if post_comments is None:
+                return None
+            return list(post_comments.values())
+
+    def sorted_comments(self, pid):
+        """
+        Get all comments of post `pid`, most upvoted first, or None if the
+        post does not exist
+        """
+        post_comments = self.get_comments(pid)
+        if post_comments is None:
+            return None
+        post_comments.sort(
+            key=lambda c: c.upvotes + self.votes.get((pid, c.id)),
+            reverse=True)
+        return post_comments
+
+    def create_comment(self, pid, text, username):
+        """
+        Create a comment with a new id on post `pid`. Returns None if the
+        post does not exist.
+        """
+        with self.stripe(pid):
+            post_comments = self.comments.get(pid)
+            if post_comments is None:
+                return None
+            comment = Comment(self.allocate_ids(), 0, text, username)
+            post_comments[comment.id] = comment
+            self.texts.add((pid, comment.id), text)
+            self.log(["comment", pid, comment.row()])
+        return comment
+
+    def create_comments(self, pid, fields):
+        """
+        Create a comment on post `pid` for each (text, username) in
+        `fields`, taking one block of ids. Returns None if the post does
+        not exist.
+        """
+        with self.stripe(pid):
+            post_comments = self.comments.get(pid)
+            if post_comments is None:
+                return None
+            first = self.allocate_ids(len(fields))
+            comments = [
+                Comment(first + i, 0, text, username)
+                for i, (text, username) in enumerate(fields)
+            ]
+            for comment in comments:
+                post_comments[comment.id] = comment
+                self.texts.add((pid, comment.id), comment.text)
+            self.log_many(
+                [["comment", pid, comment.row()] for comment in comments])
+        return comments
+
+    def get_comment(self, pid, cid):
+        """
+        Get comment `cid` of post `pid`, or None if either does not exist
+        """
+        post_comments = self.comments.get(pid)
+        if post_comments is None:
+            return None
+        return post_comments.get(cid)
+
+    def edit_comment(self, pid, cid, text):
+        """
+        Change the text of comment `cid` of post `pid`. Returns the comment,
+        or None if either does not exist.
+        """
+        with self.stripe(pid):
+            comment = self.get_comment(pid, cid)
+            if comment is None:
+                return None
+            self.texts.remove((pid, cid), comment.text)
+            comment.text = text
+            self.texts.add((pid, cid), text)
+            self.log(["edit", pid, cid, text])
+        return comment
@@ -0,0 +1,84 @@
+import sys
+import threading
+import unittest
+
+from store import Board
+
+THREADS = 8
+PER_THREAD = 2000
+
+
+class BoardThreadTest(unittest.TestCase):
+    """
+    Threads creating posts and comments at once get unique ids and lose
+    none of each other's writes
+    """
+
+    def setUp(self):
+        # Switch threads far more often than usual, so races show up
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+
+    def run_threads(self, target):
+        barrier = threading.Barrier(THREADS)
+
+        def run(index):
+            barrier.wait()
+            target(index)
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_creates(self):
+        board = Board()
+        shared = [board.create_post("shared", "l", "u") for _ in range(4)]
+        created = [[] for _ in range(THREADS)]
+
+        def create(index):
+            ids = created[index]
+            for i in range(PER_THREAD):
+                if i % 4 == 0:
+                    ids.append(("post", board.create_post("t", "l", "u").id))
+                else:
+                    pid = shared[i % len(shared)].id
+                    comment = board.create_comment(pid, "c", "u")
+                    ids.append(("comment", comment.id))
+
+        self.run_threads(create)
+
+        ids = [shared_post.id for shared_post in shared]
+        ids += [id for thread_ids in created for _, id in thread_ids]
+        self.assertEqual(len(ids), len(set(ids)))
+
+        posts = {id for thread_ids in created
+                 for kind, id in thread_ids if kind == "post"}
+        comments = {id for thread_ids in created
+                    for kind, id in thread_ids if kind == "comment"}
+        self.assertTrue(posts <= {post.id for post in board.posts.values()})
+        stored = {comment.id for post in shared
+                  for comment in board.get_comments(post.id)}
+        self.assertEqual(stored, comments)
+
+    def test_concurrent_upvotes(self):
+        board = Board()
+        post = board.create_post("t", "l", "u")
+
+        def upvote(index):
+            for _ in range(PER_THREAD):
+                board.upvote_post(post.id)
+
+        self.run_threads(upvote)
+        board.refresh_votes()
+        self.assertEqual(
+            board.serialize_post(post)["upvotes"], THREADS * PER_THREAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,5 @@
 import json
-from flask import Flask, request
+from flask import Flask, Response, request
 import db
 
 DB = db.DatabaseDriver()
@@ -18,9 +18,41 @@ def hello_world():
 @app.route("/api/users/")
 def get_all_users():
     """
-    Endpoint for getting all users from the database
+    Endpoint for getting users from the database, `limit` at a time from
+    after `after_id`, with only the comma-separated `fields`
     """
-    return json.dumps({"users": DB.get_all_users()}), 200
+    limit = request.args.get("limit", type=int)
+    if (limit is not None and limit <= 0):
+        return json.dumps({"error": "Limit must be positive"}), 400
+    after_id = request.args.get("after_id", 0, type=int)
+    fields = request.args.get("fields")
+    fields = db.LISTED_FIELDS if fields is None else tuple(fields.split(","))
+    if (not set(fields) <= set(db.USER_FIELDS)):
+        return json.dumps({"error": "Unknown field"}), 400
+
+    users = DB.iter_users(
+        fields, after_id, None if limit is None else limit + 1)
+    return Response(stream_users(users, limit), 200,
+                    mimetype="application/json")
+
+
+def stream_users(users, limit):
+    """
+    Encode users into the response as they come off the cursor. When a
+    page is full, "next_after_id" gives the `after_id` of the next page.
+    """
+    yield '{"users": ['
+    separator = ""
+    last_id = None
+    for count, (user_id, user) in enumerate(users):
+        if limit is not None and count == limit:
+            yield '], "next_after_id": %d}' % last_id
+            return
+        yield separator + json.dumps(user)
+        separator = ", "
+        last_id = user_id
+    yield "]}"
+
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -83,16 +115,14 @@ def send():
     except:
         return json.dumps({"error": "Required field unspecified"}), 400
 
-    user_sender = DB.get_user_by_id(sender_id)
-    user_receiver = DB.get_user_by_id(receiver_id)
-    if (user_sender is None or user_receiver is None):
-        return json.dumps({"error": "User not found"}), 404
-
-    if (DB.get_balance(sender_id) < amount):
-        return json.dumps({"error": "Sender balance low"}), 400
     if (amount < 0):
         return json.dumps({"error": "Amount cannot be negative"}), 400
-    DB.send_money(sender_id, receiver_id, amount)
+
+    result = DB.send_money(sender_id, receiver_id, amount)
+    if (result == db.USER_NOT_FOUND):
+        return json.dumps({"error": "User not found"}), 404
+    if (result == db.BALANCE_LOW):
+        return json.dumps({"error": "Sender balance low"}), 400
     return body, 200
 
 @app.route("/api/extra/users/", methods = ["POST"])
@@ -112,6 +142,8 @@ def create_password():
         balance = body.get("balance", 0)
     except:
         return json.dumps({"error": "Username or name field not inputted"}), 400
+    if input_password is not None and not isinstance(input_password, str):
+        return json.dumps({"error": "Password must be a string"}), 400
 
     user_id = DB.create_user(name, username, balance)
     user = DB.get_user_by_id(user_id)
@@ -153,7 +185,7 @@ def verify_send_password():
         return json.dumps({"Unauthorized error": "No password sent"}), 401
 
     if (DB.verify_password(sender_id, input_password)): 
-        send()
+        return send()
     return json.dumps({"Unauthorized error": "Wrong password"}), 401
 
 
@@ -1,5 +1,46 @@
+import contextlib
 import os
+import queue
 import sqlite3
+import threading
+
+import passwords
+
+# Outcomes of DatabaseDriver.send_money
+SENT = 0
+USER_NOT_FOUND = 1
+BALANCE_LOW = 2
+
+# Applied to every connection as it is opened
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA mmap_size=268435456;",
+]
+
+# Schema changes as (version, statements), oldest first. Never edit one
+# that has shipped; add a new version instead. Version 1 also has to work
+# on databases made before versions were recorded.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            username TEXT NOT NULL,
+            balance REAL,
+            password TEXT
+        );
+        """,
+    ]),
+]
+
+# Columns of `user` a listing may ask for, and those it gets by default
+USER_FIELDS = ("id", "name", "username", "balance")
+LISTED_FIELDS = ("id", "name", "username")
+
+# Rows read per connection checkout while streaming users
+STREAM_CHUNK = 500
 
 # From: https://goo.gl/YzypOI
 
@@ -15,6 +56,83 @@ def singleton(cls):
     return getinstance
 
 
+class ConnectionPool(object):
+    """
+    Pool of sqlite connections. Each thread checks out a connection of its
+    own for as long as it needs it, so requests no longer take turns on
+    one shared connection.
+    """
+
+    def __init__(self, database, size=8, timeout=5.0):
+        """
+        Pool up to `size` connections to `database`. `timeout` is how long
+        to wait, in seconds, for a free connection or for a locked database.
+        """
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def open(self):
+        """
+        Open a new connection with PRAGMAS applied. WAL mode keeps readers
+        from blocking the writer or each other.
+        """
+        conn = sqlite3.connect(
+            self.database, timeout=self.timeout, check_same_thread=False
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """
+        Take an idle connection, opening one if the pool is not full yet.
+        Raises queue.Empty if none frees up within the timeout.
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self.open()
+            except sqlite3.Error:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        return self.idle.get(timeout=self.timeout)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the current thread. Nested checkouts on
+        the same thread share it.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self.acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self.idle.put(conn)
+
+
 class DatabaseDriver(object):
     """
     Database driver for the Task app.
@@ -23,78 +141,114 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secure a connection with the database and 
-        store it in the instance variable `conn`
+        Secure a pool of connections with the database and 
+        store it in the instance variable `pool`. Set DB_POOL_SIZE and
+        DB_TIMEOUT to change its size and timeout in seconds.
+        Existing data is kept; only missing migrations are run.
         """
-        self.conn = sqlite3.connect(
-            "venmo.db", check_same_thread=False
+        self.pool = ConnectionPool(
+            "venmo.db",
+            size=int(os.environ.get("DB_POOL_SIZE", 8)),
+            timeout=float(os.environ.get("DB_TIMEOUT", 5))
         )
-        self.delete_user_table()
-        self.create_user_table()
+        with self.pool.connection() as conn:
+            self.migrate(conn)
+        self.passwords = passwords.PasswordChecker()
 
-    def create_user_table(self):
+    def migrate(self, conn):
         """
-        Create a user table using SQL
+        Bring the schema up to date by running every migration newer than
+        the version recorded in the database. The check and the migrations
+        share one write transaction, so processes opening the database at
+        the same time run each migration exactly once.
         """
-        cursor = self.conn.execute("""
-            CREATE TABLE user (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                username TEXT NOT NULL,
-                balance REAL,
-                password TEXT
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL
             );
         """)
+        conn.execute("BEGIN IMMEDIATE;")
+        cursor = conn.execute("SELECT MAX(version) FROM schema_version;")
+        version = cursor.fetchone()[0] or 0
+        for number, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("""
+                INSERT INTO schema_version (version) VALUES (?);
+            """, (number,))
+        conn.commit()
 
-    def delete_user_table(self):
+    def get_all_users(self):
         """
-        Delete a user table using SQL
+        Get all users' id, name, and username using SQL
         """
-        self.conn.execute("DROP TABLE IF EXISTS user;")
+        return [user for _, user in self.iter_users()]
 
-    def get_all_users(self):
+    def iter_users(self, fields=LISTED_FIELDS, after_id=0, limit=None):
         """
-        Get all users' id, name, and username using SQL
+        Yield (id, user) for up to `limit` users with ids above `after_id`
+        in id order, each user holding only `fields` (a subset of
+        USER_FIELDS). Rows are read STREAM_CHUNK at a time, using the
+        primary key to start right after the last one read, and the
+        connection goes back to the pool before any are yielded. A slow
+        client reading a long stream then holds no connection.
         """
-        cursor = self.conn.execute("""
-            SELECT id, name, username FROM user; 
-        """)
-        users = []
-        for row in cursor:
-            users.append({"id": row[0], "name": row[1], "username": row[2]})
-        return users
+        columns = ", ".join(("id",) + tuple(fields))
+        remaining = limit
+        while remaining is None or remaining > 0:
+            chunk = STREAM_CHUNK if remaining is None else min(
+                remaining, STREAM_CHUNK)
+            with self.pool.connection() as conn:
+                rows = conn.execute("""
+                    SELECT %s FROM user WHERE id > ? ORDER BY id LIMIT ?;
+                """ % columns, (after_id, chunk)).fetchall()
+            for row in rows:
+                yield row[0], dict(zip(fields, row[1:]))
+            if len(rows) < chunk:
+                return
+            after_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
 
     def create_user(self, name, username, balance):
         """
         Create a user with name, username, and balance using SQL. 
         Assume balance is 0 if no input. 
         """
-        cursor = self.conn.execute("""
-            INSERT INTO user (name, username, balance) VALUES (?, ?, ?);
-        """, (name, username, balance)
-        )
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            cursor = conn.execute("""
+                INSERT INTO user (name, username, balance) VALUES (?, ?, ?);
+            """, (name, username, balance)
+            )
+            conn.commit()
         return cursor.lastrowid
 
     def set_password(self,id, input_password): 
         """
-        set password to the database for user of a specific id
+        set password to the database for user of a specific id,
+        stored as a salted hash
         """
-        cursor = self.conn.execute("""
-            UPDATE user SET password = ? WHERE id = ?;
-        """, (input_password, id))
-        self.conn.commit() 
+        if input_password is not None:
+            input_password = self.passwords.hash(input_password)
+        with self.pool.connection() as conn:
+            conn.execute("""
+                UPDATE user SET password = ? WHERE id = ?;
+            """, (input_password, id))
+            conn.commit()
 
 
     def get_user_by_id(self, id):
         """
         Get a user from the database by their id using SQL
         """
-        cursor = self.conn.execute("""
-            SELECT * FROM user WHERE id= ?;
-        """, (id,))
-        for row in cursor:
-            return {"id": row[0], "name": row[1], "username": row[2], "balance": row[3]}
+        with self.pool.connection() as conn:
+            cursor = conn.execute("""
+                SELECT * FROM user WHERE id= ?;
+            """, (id,))
+            for row in cursor:
+                return {"id": row[0], "name": row[1], "username": row[2], "balance": row[3]}
 
         return None
 
@@ -102,46 +256,72 @@ class DatabaseDriver(object):
         """
         Delete a user from the database by their id using SQL
         """
-        cursor = self.conn.execute("""
-        DELETE FROM user WHERE id = ?;
-        """, (id,))
-        self.conn.commit()
+        with self.pool.connection() as conn:
+            conn.execute("""
+            DELETE FROM user WHERE id = ?;
+            """, (id,))
+            conn.commit()
 
     def get_balance(self, id):
         """
         Helper function for send_money to get the current balance of user
         using SQL
         """
-        cursor = self.conn.execute("""
-        SELECT balance FROM user WHERE id = ?;
-        """, (id,))
-        for row in cursor:
-            return row[0]
+        with self.pool.connection() as conn:
+            cursor = conn.execute("""
+            SELECT balance FROM user WHERE id = ?;
+            """, (id,))
+            for row in cursor:
+                return row[0]
         return 0
 
     def send_money(self, sender, receiver, amount):
         """
-        Change balance of sender and receiver based on amount using SQL
+        Move amount from sender to receiver in one transaction using SQL.
+        The sender's balance is checked and taken from in the same
+        statement, so concurrent transfers can never overdraw it.
+        Returns SENT, USER_NOT_FOUND or BALANCE_LOW.
         """
-        self.conn.execute("""
-        UPDATE user SET balance = ? where id = ?; 
-        """, ((self.get_balance(sender) - amount), sender))
-        self.conn.execute("""
-        UPDATE user SET balance = ? where id = ?;
-        """, ((self.get_balance(receiver) + amount), receiver))
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            cursor = conn.execute("""
+            UPDATE user SET balance = balance - ?
+            WHERE id = ? AND balance >= ?
+            AND EXISTS (SELECT 1 FROM user WHERE id = ?);
+            """, (amount, sender, amount, receiver))
+            if cursor.rowcount == 1:
+                conn.execute("""
+                UPDATE user SET balance = balance + ? WHERE id = ?;
+                """, (amount, receiver))
+                conn.commit()
+                return SENT
+
+            # Nothing was changed, so only the reason is left to find
+            cursor = conn.execute("""
+            SELECT COUNT(*) FROM user WHERE id IN (?, ?);
+            """, (sender, receiver))
+            found = cursor.fetchone()[0]
+            conn.rollback()
+        if found < len({sender, receiver}):
+            return USER_NOT_FOUND
+        return BALANCE_LOW
 
     def verify_password(self, id, input_password): 
         """
-        Verify the password of the user with the given id
+        Verify the password of the user with the given id.
+        A password still stored in plain text is hashed once it checks out.
         """
-        cursor = self.conn.execute("""
-        SELECT password FROM user WHERE id = ?;
-        """,(id,))
+        with self.pool.connection() as conn:
+            cursor = conn.execute("""
+            SELECT password FROM user WHERE id = ?;
+            """,(id,))
+            row = cursor.fetchone()
 
-        for row in cursor:
-            return row[0]==input_password
-        
-        return False
+        if row is None or not self.passwords.check(id, input_password, row[0]):
+            return False
+        if not passwords.is_hashed(row[0]):
+            self.set_password(id, input_password)
+        return True
 
 # Only <=1 instance of the database driver
 # exists within the app at all times
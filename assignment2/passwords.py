@@ -0,0 +1,122 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 200000
+
+# Secret for the verification cache's digests. It only has to outlive
+# the cache, so a new one is made for every process.
+CACHE_KEY = os.urandom(32)
+
+
+def hash_password(password, iterations=ITERATIONS):
+    """
+    Hash a password with a random salt into
+    "pbkdf2_sha256$<iterations>$<salt>$<hash>"
+    """
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac(
+        "sha256", password.encode("utf-8"), salt, iterations)
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt.hex(), digest.hex())
+
+
+def check_password(password, stored):
+    """
+    Check a password against a value made by hash_password. Values stored
+    before passwords were hashed are compared as plain text.
+    """
+    if not stored.startswith(ALGORITHM + "$"):
+        return hmac.compare_digest(
+            password.encode("utf-8"), stored.encode("utf-8"))
+    _, iterations, salt, digest = stored.split("$")
+    attempt = hashlib.pbkdf2_hmac(
+        "sha256", password.encode("utf-8"), bytes.fromhex(salt),
+        int(iterations))
+    return hmac.compare_digest(attempt, bytes.fromhex(digest))
+
+
+def is_hashed(stored):
+    """
+    Tell whether a stored password was made by hash_password
+    """
+    return stored.startswith(ALGORITHM + "$")
+
+
+class PasswordChecker(object):
+    """
+    Hashes and checks passwords in a pool of worker processes, so the slow
+    hash does not hold up the request threads, and remembers recent
+    successful checks so repeat requests skip the hash entirely.
+    """
+
+    def __init__(self, cache_size=10000, ttl=300, workers=None):
+        """
+        Remember up to `cache_size` successful checks for `ttl` seconds
+        each. `workers` defaults to one process per CPU.
+        """
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.workers = workers
+        self.executor = None
+        self.verified = OrderedDict()
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        """
+        Run `fn` in a worker process and wait for its result
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor.submit(fn, *args).result()
+
+    def hash(self, password):
+        """
+        Hash a password for storage. Raises TypeError unless it is a
+        string.
+        """
+        if not isinstance(password, str):
+            raise TypeError("password must be a string")
+        return self.run(hash_password, password)
+
+    def cache_key(self, user_id, password, stored):
+        """
+        Digest identifying a check. The stored hash is part of it, so a
+        changed password never matches an old entry.
+        """
+        message = "%s\0%s\0%s" % (user_id, stored, password)
+        return hmac.new(
+            CACHE_KEY, message.encode("utf-8"), hashlib.sha256).digest()
+
+    def check(self, user_id, password, stored):
+        """
+        Check the password of user `user_id` against its stored hash.
+        Anything but a string, e.g. a number sent as JSON, never matches.
+        """
+        if not isinstance(password, str) or not isinstance(stored, str):
+            return False
+
+        key = self.cache_key(user_id, password, stored)
+        now = time.monotonic()
+        with self.lock:
+            expires = self.verified.get(key)
+            if expires is not None:
+                if expires > now:
+                    self.verified.move_to_end(key)
+                    return True
+                del self.verified[key]
+
+        if not self.run(check_password, password, stored):
+            return False
+
+        with self.lock:
+            self.verified[key] = now + self.ttl
+            self.verified.move_to_end(key)
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
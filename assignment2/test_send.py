@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+# The driver opens venmo.db in the working directory on import, so move to
+# a scratch one first
+DIRECTORY = tempfile.TemporaryDirectory()
+os.chdir(DIRECTORY.name)
+
+from app import app
+from app import DB
+
+THREADS = 8
+SENDS = 40
+BALANCE = 25
+
+
+class SendTest(unittest.TestCase):
+    """
+    Concurrent transfers out of one balance never overdraw it and lose no
+    updates
+    """
+
+    def post(self, url, body, client=None):
+        client = client or app.test_client()
+        response = client.post(url, data=json.dumps(body))
+        return response.status_code, json.loads(response.data)
+
+    def create_user(self, balance):
+        code, user = self.post("/api/users/", {
+            "name": "u", "username": "u", "balance": balance})
+        self.assertEqual(code, 201, user)
+        return user["id"]
+
+    def test_send_race(self):
+        sender = self.create_user(BALANCE)
+        receivers = [self.create_user(0) for _ in range(THREADS)]
+
+        barrier = threading.Barrier(THREADS)
+        codes = []
+
+        def send(receiver):
+            client = app.test_client()
+            barrier.wait()
+            for _ in range(SENDS):
+                codes.append(self.post("/api/send/", {
+                    "sender_id": sender, "receiver_id": receiver,
+                    "amount": 1}, client)[0])
+
+        threads = [threading.Thread(target=send, args=(receiver,))
+                   for receiver in receivers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(codes.count(200), BALANCE)
+        self.assertEqual(codes.count(400), THREADS * SENDS - BALANCE)
+        self.assertEqual(DB.get_balance(sender), 0)
+        self.assertEqual(
+            sum(DB.get_balance(receiver) for receiver in receivers), BALANCE)
+
+
+if __name__ == "__main__":
+    unittest.main()
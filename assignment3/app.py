@@ -1,8 +1,10 @@
 from datetime import datetime
 import json
+import math
 
 import db
 from flask import Flask
+from flask import Response
 from flask import request
 
 DB = db.DatabaseDriver()
@@ -11,12 +13,6 @@ DB = db.DatabaseDriver()
 app = Flask(__name__)
 
 
-def check_balance(sender, amount):
-    if (DB.get_balance(sender) < amount):
-        return False
-    return True
-
-
 def success_response(body, code=200):
     """
     Give success response of 200 given the body
@@ -42,9 +38,41 @@ def hello_world():
 @app.route("/api/users/")
 def get_all_users():
     """
-    Endpoint for getting all users from the database
+    Endpoint for getting users from the database, `limit` at a time from
+    after `after_id`, with only the comma-separated `fields`
+    """
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return failure_response("Limit must be positive", 400)
+    after_id = request.args.get("after_id", 0, type=int)
+    fields = request.args.get("fields")
+    fields = db.LISTED_FIELDS if fields is None else tuple(fields.split(","))
+    if not set(fields) <= set(db.USER_FIELDS):
+        return failure_response("Unknown field", 400)
+
+    users = DB.iter_users(
+        fields, after_id, None if limit is None else limit + 1)
+    return Response(stream_users(users, limit), 200,
+                    mimetype="application/json")
+
+
+def stream_users(users, limit):
     """
-    return success_response({"users": DB.get_all_users()})
+    Encode users into the response as they come off the cursor. When a
+    page is full, "next_after_id" gives the `after_id` of the next page.
+    """
+    yield '{"users": ['
+    separator = ""
+    last_id = None
+    for count, (user_id, user) in enumerate(users):
+        if limit is not None and count == limit:
+            yield '], "next_after_id": %d}' % last_id
+            return
+        yield separator + json.dumps(user)
+        separator = ", "
+        last_id = user_id
+    yield "]}"
+
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -58,26 +86,85 @@ def create_user():
     balance = body.get("balance", 0)
     if name is None or username is None:
         return failure_response("Username or name field not inputted", 400)
+    if balance is not None and not db.is_amount(balance):
+        return failure_response("Invalid balance", 400)
     user_id = DB.create_user(name, username, balance)
     user = DB.get_user_by_id(user_id)
     if user is None:
         return failure_response("Something went wrong creating a user", 400)
 
+    # A new user has no transactions yet, so there is nothing to look up
+    user["transactions"] = []
     return success_response(user, 201)
 
 
 @app.route("/api/users/<int:uid>/")
 def get_specific_user(uid):
     """
-    Endpoint to get a user by its id
+    Endpoint to get a user by its id. Pass `include=transactions` to embed
+    their first `limit` transactions.
     """
-    user = DB.get_user_by_id(uid)
+    include = request.args.get("include", "").split(",")
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return failure_response("Limit must be positive", 400)
+
+    user = DB.get_user_by_id(uid, "transactions" in include, limit)
     if user is None:
         return failure_response("User not found")
 
     return success_response(user)
 
 
+@app.route("/api/users/<int:uid>/transactions/")
+def get_user_transactions(uid):
+    """
+    Endpoint to get the transactions of a user, oldest first, `limit` at a
+    time from after the transaction `after_id`
+    """
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return failure_response("Limit must be positive", 400)
+    after_id = request.args.get("after_id", type=int)
+
+    if DB.get_user_by_id(uid) is None:
+        return failure_response("User not found")
+    if after_id is not None and DB.get_transaction(after_id) is None:
+        return failure_response("Transaction not found", 400)
+
+    # Rows come back already encoded and are joined into the body as is
+    txns = DB.get_user_transactions(
+        uid, after_id, None if limit is None else limit + 1, as_json=True)
+    body = '{"transactions": [' + ", ".join(
+        txn for _, txn in txns[:limit]) + "]"
+    if limit is not None and len(txns) > limit:
+        body += ', "next_after_id": %d' % txns[limit - 1][0]
+    return body + "}", 200
+
+
+@app.route("/api/users/<int:uid>/balance/")
+def get_user_balance(uid):
+    """
+    Endpoint to get the balance of a user, or what it was at the time
+    `at` (e.g. "2022-10-31 12:00:00")
+    """
+    at = request.args.get("at")
+    if at is None:
+        balance = DB.get_balance(uid)
+        if balance is None:
+            return failure_response("User not found")
+        return success_response({"id": uid, "balance": balance})
+
+    try:
+        at = datetime.fromisoformat(at).__str__()
+    except ValueError:
+        return failure_response("Invalid time", 400)
+    balance = DB.get_balance_at(uid, at)
+    if balance is None:
+        return failure_response("User not found")
+    return success_response({"id": uid, "balance": balance, "at": at})
+
+
 @app.route("/api/users/<int:uid>/", methods=["DELETE"])
 def delete_specific_user(uid):
     """
@@ -94,7 +181,9 @@ def delete_specific_user(uid):
 @app.route("/api/transactions/", methods=["POST"])
 def make_transactions():
     """
-    Endpoint for making a transaction
+    Endpoint for making a transaction. Checking the balance, moving the
+    money and recording the transaction happen in one database
+    transaction.
     """
     body = json.loads(request.data)
     sender = body.get("sender_id", None)
@@ -105,46 +194,110 @@ def make_transactions():
         return failure_response("Required fields not filled", 400)
 
     accepted = body.get("accepted", None)
-
-    if (accepted is not None and accepted):
-        if check_balance(sender, amount):
-            DB.send_money(sender, receiver, amount)
-        else:
-            return failure_response("Sender balance low", 403)
-
-    timestamp = datetime.now().__str__()
-    txn_id = DB.create_transactions(
-        sender, receiver, timestamp, amount, message, accepted)
-    txn = DB.get_transaction(txn_id)
-    if txn is None:
-        return failure_response("Something went wrong making transaction", 400)
+    if accepted is not None:
+        accepted = bool(accepted)
+
+    txn, = DB.create_transaction_batch(
+        [(sender, receiver, amount, message, accepted)],
+        datetime.now().__str__())
+    if txn == db.INVALID_AMOUNT:
+        return failure_response("Invalid amount", 400)
+    if txn == db.USER_NOT_FOUND:
+        return failure_response("User not found")
+    if txn == db.BALANCE_LOW:
+        return failure_response("Sender balance low", 403)
     return success_response(txn, 201)
 
 
-@app.route("/api/transactions/<int:tid>/", methods=["POST"])
-def action(tid):
-    txn = DB.get_transaction(tid)
-    if txn is None:
-        return failure_response("Transaction not found")
+@app.route("/api/transactions/batch/", methods=["POST"])
+def make_transaction_batch():
+    """
+    Endpoint for making many transactions at once. By default the batch is
+    all or nothing; pass "atomic": false to make every valid transfer and
+    skip the rest. Each transfer gets its transaction or an error back,
+    in order, or null if it was left out of a batch that was not made.
+    """
+    body = json.loads(request.data)
+    atomic = body.get("atomic", True)
+    transfers = body.get("transfers")
+    if not isinstance(transfers, list):
+        return failure_response("Required fields not filled", 400)
+
+    valid = []
+    errors = {}
+    for index, transfer in enumerate(transfers):
+        if not isinstance(transfer, dict):
+            errors[index] = "Required fields not filled"
+            continue
+        sender = transfer.get("sender_id")
+        receiver = transfer.get("receiver_id")
+        amount = transfer.get("amount")
+        if (sender is None or receiver is None
+                or not isinstance(amount, (int, float))
+                or isinstance(amount, bool)):
+            errors[index] = "Required fields not filled"
+            continue
+        if not (amount > 0 and math.isfinite(amount)):
+            errors[index] = "Invalid amount"
+            continue
+        accepted = transfer.get("accepted")
+        valid.append((index, (
+            sender, receiver, amount, transfer.get("message"),
+            None if accepted is None else bool(accepted))))
+
+    if valid and not (atomic and errors):
+        created = DB.create_transaction_batch(
+            [transfer for _, transfer in valid],
+            datetime.now().__str__(), atomic)
+    else:
+        created = [None] * len(valid)
+
+    results = [None] * len(transfers)
+    for index, message in errors.items():
+        results[index] = {"error": message}
+    made = 0
+    for (index, _), result in zip(valid, created):
+        if result == db.INVALID_AMOUNT:
+            result = {"error": "Invalid amount"}
+        elif result == db.USER_NOT_FOUND:
+            result = {"error": "User not found"}
+        elif result == db.BALANCE_LOW:
+            result = {"error": "Sender balance low"}
+        elif result is not None:
+            made += 1
+        results[index] = result
+
+    if made == 0 and transfers:
+        return json.dumps({
+            "error": "No transactions made", "transactions": results}), 403
+    return success_response({"transactions": results}, 201)
 
-    accepted = txn.get("accepted")
-    if (accepted is not None):
-        if accepted:
-            return failure_response("transaction already accepted", 403)
-        else:
-            return failure_response("transaction already denied", 403)
 
+@app.route("/api/transactions/<int:tid>/", methods=["POST"])
+def action(tid):
+    """
+    Endpoint to accept or deny a pending transaction. Settling it and
+    moving the money happen in one database transaction.
+    """
     body = json.loads(request.data)
     accepted = body.get("accepted")
-    if (accepted):
-        if (check_balance(txn.get("sender_id"), txn.get("amount"))):
-            DB.send_money(txn.get("sender_id"), txn.get(
-                "receiver_id"), txn.get("amount"))
-        else:
-            return failure_response("Sender balance low", 403)
-
-    DB.update_transaction(tid, datetime.now().__str__(), accepted)
-    txn = DB.get_transaction(tid)
+    if accepted is None:
+        return failure_response("Required fields not filled", 400)
+
+    accepted = bool(accepted)
+    result, txn = DB.settle_transaction(
+        tid, accepted, datetime.now().__str__())
+
+    if result == db.TRANSACTION_NOT_FOUND:
+        return failure_response("Transaction not found")
+    if result == db.ALREADY_SETTLED:
+        if txn.get("accepted"):
+            return failure_response("transaction already accepted", 403)
+        return failure_response("transaction already denied", 403)
+    if result == db.USER_NOT_FOUND:
+        return failure_response("User not found")
+    if result == db.BALANCE_LOW:
+        return failure_response("Sender balance low", 403)
     return success_response(txn)
 
 
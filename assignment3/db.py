@@ -1,4 +1,160 @@
+import math
+import os
 import sqlite3
+from datetime import datetime
+from decimal import Decimal
+
+import rows
+import writer
+
+# Results of settling a pending transaction or making one
+SETTLED = 0
+TRANSACTION_NOT_FOUND = 1
+ALREADY_SETTLED = 2
+BALANCE_LOW = 3
+USER_NOT_FOUND = 4
+INVALID_AMOUNT = 5
+
+# Stay under SQLite's limit on parameters in one statement
+MAX_PARAMETERS = 500
+
+# Largest amount of money taken, so its cents stay exact in a float
+MAX_AMOUNT = 10 ** 13
+
+# A user's balance is checkpointed once this many ledger entries have
+# been added since their last checkpoint
+CHECKPOINT_EVERY = 1000
+
+# UPDATE ... RETURNING needs SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Applied to the connection when it is opened
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA mmap_size=268435456;",
+]
+
+# Schema changes as (version, statements), oldest first. Never edit one
+# that has shipped; add a new version instead. Version 1 also has to work
+# on databases made before versions were recorded.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS user (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            username TEXT NOT NULL,
+            balance REAL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 
+            timestamp TEXT NOT NULL, 
+            sender_id INTEGER SECONDARY KEY NOT NULL,
+            receiver_id INTEGER SECONDARY KEY NOT NULL,
+            amount REAL NOT NULL,
+            message TEXT,
+            accepted BOOL
+        );
+        """,
+    ]),
+    (2, [
+        # An index on one column ends in the rowid, so each user's
+        # transactions are found in id order
+        """
+        CREATE INDEX IF NOT EXISTS transactions_sender
+        ON transactions (sender_id);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS transactions_receiver
+        ON transactions (receiver_id);
+        """,
+    ]),
+    (3, [
+        # Balances move to whole cents kept in step with a ledger. Each
+        # existing balance becomes the user's opening entry.
+        """
+        ALTER TABLE user
+        ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0;
+        """,
+        """
+        ALTER TABLE user
+        ADD COLUMN ledger_entries INTEGER NOT NULL DEFAULT 0;
+        """,
+        """
+        UPDATE user SET
+        balance_cents = CAST(ROUND(COALESCE(balance, 0) * 100) AS INTEGER),
+        ledger_entries = 1;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            transaction_id INTEGER,
+            timestamp TEXT NOT NULL,
+            amount INTEGER NOT NULL
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ledger_user
+        ON ledger (user_id, timestamp, amount);
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS balance_checkpoints (
+            user_id INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            balance INTEGER NOT NULL
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS balance_checkpoints_user
+        ON balance_checkpoints (user_id, timestamp, ledger_id);
+        """,
+        """
+        INSERT INTO ledger (user_id, timestamp, amount)
+        SELECT id, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'),
+        balance_cents FROM user;
+        """,
+    ]),
+]
+
+# Columns of `user` a listing may ask for, and those it gets by default
+USER_FIELDS = ("id", "name", "username", "balance")
+LISTED_FIELDS = ("id", "name", "username")
+
+# How fields of `user` are selected, where that is not by their name
+USER_COLUMNS = {
+    "balance": "balance_cents / 100.0 AS balance",
+}
+
+
+def is_amount(value):
+    """
+    Check that a value read from a request is a finite number of money in
+    range, so it can be given to `to_cents`. JSON booleans are not taken
+    for numbers.
+    """
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and math.isfinite(value) and abs(value) <= MAX_AMOUNT)
+
+
+def to_cents(amount):
+    """
+    Convert an amount of money to whole cents, rounding half to even.
+    Going through its decimal text keeps e.g. 1.005 from becoming 1.00.
+    """
+    return int(round(Decimal(repr(amount)) * 100))
+
+
+def now():
+    """
+    Current time as stored in timestamps
+    """
+    return datetime.now().__str__()
+
 
 # From: https://goo.gl/YzypOI
 
@@ -23,137 +179,166 @@ class DatabaseDriver(object):
     def __init__(self):
         """
         Secure a connection with the database and 
-        store it in the instance variable `conn`
+        store it in the instance variable `conn`.
+        Existing data is kept; only missing migrations are run.
         """
-        self.conn = sqlite3.connect(
-            "venmo.db", check_same_thread=False
-        )
-        self.delete_user_table()
-        self.delete_transactions_table()
-        self.create_user_table()
-        self.create_transactions_table()
+        self.conn = self.connect(check_same_thread=False)
+        self.migrate(self.conn)
+        self.writer = writer.GroupCommitWriter(
+            self.connect_writer,
+            float(os.environ.get("DB_COMMIT_DELAY", "0")),
+            int(os.environ.get("DB_COMMIT_BATCH", "1000")))
+        self.inherited = []
+        os.register_at_fork(after_in_child=self.after_fork)
 
-    def create_user_table(self):
+    def after_fork(self):
         """
-        Create a user table using SQL
+        Give a forked process, e.g. a server worker forked after the app
+        was loaded, connections and a writer thread of its own. SQLite
+        connections must not be used across a fork, so the parent's are
+        kept unused rather than closed from the child.
         """
-        self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS user (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                username TEXT NOT NULL,
-                balance REAL
-            );
-        """)
+        self.inherited.append(self.conn)
+        self.conn = self.connect(check_same_thread=False)
+        self.writer.start()
 
-    def delete_user_table(self):
+    def connect(self, **kwargs):
         """
-        Delete a user table using SQL
+        Open a connection to the database
         """
-        self.conn.execute("DROP TABLE IF EXISTS user;")
+        conn = sqlite3.connect("venmo.db", timeout=5.0, **kwargs)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
 
-    def create_transactions_table(self):
+    def connect_writer(self):
         """
-        Create the transactions table using SQL
+        Open the connection every write goes through. A write is only
+        reported done once its commit is on disk, which costs an fsync per
+        commit, but the writer shares each commit between many writes.
         """
-        self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                timestamp TEXT NOT NULL, 
-                sender_id INTEGER SECONDARY KEY NOT NULL,
-                receiver_id INTEGER SECONDARY KEY NOT NULL,
-                amount REAL NOT NULL,
-                message TEXT,
-                accepted BOOL
-            );
-        """)
+        conn = self.connect(isolation_level=None)
+        conn.execute("PRAGMA synchronous=FULL;")
+        return conn
 
-    def delete_transactions_table(self):
+    def write(self, fn, *args):
         """
-        Delete a transactions table using SQL
+        Have the writer run `fn(conn, *args)` and wait until it has been
+        committed. Use `self.writer.submit` instead to get a future.
         """
-        self.conn.execute("DROP TABLE IF EXISTS transactions;")
+        return self.writer.submit(fn, *args).result()
+
+    def migrate(self, conn):
+        """
+        Bring the schema up to date by running every migration newer than
+        the version recorded in the database. The check and the migrations
+        share one write transaction, so processes opening the database at
+        the same time run each migration exactly once.
+        """
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL
+            );
+        """)
+        conn.execute("BEGIN IMMEDIATE;")
+        cursor = conn.execute("SELECT MAX(version) FROM schema_version;")
+        version = cursor.fetchone()[0] or 0
+        for number, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("""
+                INSERT INTO schema_version (version) VALUES (?);
+            """, (number,))
+        conn.commit()
 
     def get_all_users(self):
         """
         Get all users' id, name, and username using SQL
         """
+        return [user for _, user in self.iter_users()]
+
+    def iter_users(self, fields=LISTED_FIELDS, after_id=0, limit=None):
+        """
+        Yield (id, user) for up to `limit` users with ids above `after_id`
+        in id order, each user holding only `fields` (a subset of
+        USER_FIELDS). Rows are read from the cursor as they are yielded,
+        using the primary key to start right after `after_id`.
+        """
+        columns = ", ".join(
+            ("id",) + tuple(USER_COLUMNS.get(f, f) for f in fields))
         cursor = self.conn.execute("""
-            SELECT id, name, username FROM user; 
-        """)
-        users = []
+            SELECT %s FROM user WHERE id > ? ORDER BY id LIMIT ?;
+        """ % columns, (after_id, -1 if limit is None else limit))
         for row in cursor:
-            users.append({"id": row[0], "name": row[1], "username": row[2]})
-        return users
+            yield row[0], dict(zip(fields, row[1:]))
 
     def create_user(self, name, username, balance):
         """
         Create a user with name, username, and balance using SQL. 
         Assume balance is 0 if no input. 
         """
-        cursor = self.conn.execute("""
-            INSERT INTO user (name, username, balance) VALUES (?, ?, ?);
-        """, (name, username, balance)
+        return self.write(self.insert_user, name, username, balance)
+
+    def insert_user(self, conn, name, username, balance):
+        """
+        Write for create_user
+        """
+        cursor = conn.execute("""
+            INSERT INTO user (name, username) VALUES (?, ?);
+        """, (name, username)
         )
-        self.conn.commit()
-        return cursor.lastrowid
+        user_id = cursor.lastrowid
+        self.add_entries(conn, [(user_id, to_cents(balance or 0), None)])
+        return user_id
 
-    def get_user_transactions(self, user_id):
+    def get_user_transactions(self, user_id, after_id=None, limit=None,
+                              as_json=False):
         """
-        Get all transactions that involve user with id = user_id using SQL
+        Get the transactions that involve user with id = user_id using SQL,
+        oldest first. Pass the id of the last transaction of a page as
+        `after_id` to get up to `limit` transactions of the next one.
+        Both halves are read in id order off the sender and receiver
+        indexes and merged, so the cost follows the page size rather than
+        the size of the table. Ids never change, unlike timestamps, so a
+        transaction settled meanwhile is neither repeated nor skipped.
+        With `as_json` each transaction is given as (id, text of a JSON
+        object).
         """
         cursor = self.conn.execute("""
-        SELECT * FROM transactions WHERE sender_id = ?; 
-        """, (user_id,))
-        txns = []
-        for row in cursor:
-            if (row[6] is None):
-                accepted = None
-            else:
-                accepted = bool(row[6])
-            txns.append({
-                "id": row[0],
-                "timestamp": row[1],
-                "sender_id": row[2],
-                "receiver_id": row[3],
-                "amount": row[4],
-                "message": row[5],
-                "accepted": accepted
-            })
-        cursor = self.conn.execute("""
-        SELECT * FROM transactions WHERE receiver_id = ?; 
-        """, (user_id,))
-        for row in cursor:
-            if (row[6] is None):
-                accepted = None
-            else:
-                accepted = bool(row[6])
-            txns.append({
-                "id": row[0],
-                "timestamp": row[1],
-                "sender_id": row[2],
-                "receiver_id": row[3],
-                "amount": row[4],
-                "message": row[5],
-                "accepted": accepted
-            })
-        return txns
-
-    def get_user_by_id(self, id):
-        """
-        Get a user from the database by their id using SQL
+        SELECT * FROM transactions
+        WHERE sender_id = :user AND id > :after
+        UNION ALL
+        SELECT * FROM transactions
+        WHERE receiver_id = :user AND sender_id != :user AND id > :after
+        ORDER BY id LIMIT :limit;
+        """, {
+            "user": user_id,
+            "after": 0 if after_id is None else after_id,
+            "limit": -1 if limit is None else limit
+        })
+        if as_json:
+            mapper = rows.mapper_for(cursor, as_json=True)
+            index = mapper.columns.index("id")
+            return [(row[index], mapper.map(row)) for row in cursor]
+        return list(rows.mapped(cursor))
+
+    def get_user_by_id(self, id, include_transactions=False, limit=None):
+        """
+        Get a user from the database by their id using SQL. Their first
+        `limit` transactions are only looked up and embedded when
+        `include_transactions` is set.
         """
         cursor = self.conn.execute("""
-            SELECT * FROM user WHERE id= ?;
+            SELECT id, name, username, balance_cents / 100.0 AS balance
+            FROM user WHERE id= ?;
         """, (id,))
-        for row in cursor:
-            return {
-                "id": row[0],
-                "name": row[1],
-                "username": row[2],
-                "balance": row[3],
-                "transactions": self.get_user_transactions(id)
-            }
+        for user in rows.mapped(cursor):
+            if include_transactions:
+                user["transactions"] = self.get_user_transactions(
+                    id, limit=limit)
+            return user
 
         return None
 
@@ -161,52 +346,213 @@ class DatabaseDriver(object):
         """
         Delete a user from the database by their id using SQL
         """
-        cursor = self.conn.execute("""
+        self.write(self.remove_user, id)
+
+    def remove_user(self, conn, id):
+        """
+        Write for delete_user_by_id
+        """
+        conn.execute("""
         DELETE FROM user WHERE id = ?;
         """, (id,))
-        self.conn.execute("""
+        conn.execute("""
         DELETE FROM transactions WHERE sender_id = ?;
         """, (id,))
-        self.conn.execute("""
+        conn.execute("""
         DELETE FROM transactions WHERE receiver_id = ?;
         """, (id,))
-        self.conn.commit()
 
     def get_balance(self, id):
         """
-        Helper function for send_money to get the current balance of user
-        using SQL
+        Get the current balance of user using SQL, or None if there is no
+        such user
         """
         cursor = self.conn.execute("""
-        SELECT balance FROM user WHERE id = ?;
+        SELECT balance_cents FROM user WHERE id = ?;
         """, (id,))
         for row in cursor:
-            return row[0]
-        return -1
+            return row[0] / 100
+        return None
 
-    def send_money(self, sender, receiver, amount):
+    def get_balance_at(self, id, at):
         """
-        Change balance of sender and receiver based on amount using SQL
+        Get the balance of user as it was at time `at`, a timestamp string,
+        or None if there is no such user. Only the user's ledger entries
+        since their last checkpoint before `at` are added up.
         """
-        self.conn.execute("""
-        UPDATE user SET balance = ? where id = ?; 
-        """, ((self.get_balance(sender) - amount), sender))
-        self.conn.execute("""
-        UPDATE user SET balance = ? where id = ?;
-        """, ((self.get_balance(receiver) + amount), receiver))
-        self.conn.commit()
+        if self.get_balance(id) is None:
+            return None
+        cursor = self.conn.execute("""
+        SELECT ledger_id, timestamp, balance FROM balance_checkpoints
+        WHERE user_id = ? AND timestamp <= ?
+        ORDER BY timestamp DESC, ledger_id DESC LIMIT 1;
+        """, (id, at))
+        ledger_id, timestamp, balance = cursor.fetchone() or (0, "", 0)
+        cursor = self.conn.execute("""
+        SELECT COALESCE(SUM(amount), 0) FROM ledger
+        WHERE user_id = ? AND timestamp >= ? AND timestamp <= ?
+        AND id > ?;
+        """, (id, timestamp, at, ledger_id))
+        return (balance + cursor.fetchone()[0]) / 100
+
+    def add_entries(self, conn, entries):
+        """
+        Append (user id, cents, transaction id) entries to the ledger and
+        apply them to the users' balances, inside the caller's transaction
+        on `conn`. Users with enough entries since their last checkpoint
+        get a new one.
+        """
+        timestamp = now()
+        conn.executemany("""
+        INSERT INTO ledger (user_id, transaction_id, timestamp, amount)
+        VALUES (?, ?, ?, ?);
+        """, [(user, txn, timestamp, cents) for user, cents, txn in entries])
+        # Only the writer thread writes, so the new ids run up to the last
+        # one inserted
+        cursor = conn.execute("SELECT last_insert_rowid();")
+        first_id = cursor.fetchone()[0] - len(entries) + 1
+
+        changes = {}
+        for ledger_id, (user, cents, _) in enumerate(entries, first_id):
+            total, count, _ = changes.get(user, (0, 0, 0))
+            changes[user] = (total + cents, count + 1, ledger_id)
+        conn.executemany("""
+        UPDATE user SET balance_cents = balance_cents + ?,
+        ledger_entries = ledger_entries + ? WHERE id = ?;
+        """, [(total, count, user)
+              for user, (total, count, _) in changes.items()])
+
+        users = list(changes)
+        for start in range(0, len(users), MAX_PARAMETERS):
+            chunk = users[start:start + MAX_PARAMETERS]
+            cursor = conn.execute("""
+            SELECT id, balance_cents FROM user
+            WHERE id IN (%s) AND ledger_entries >= ?;
+            """ % ", ".join("?" * len(chunk)), chunk + [CHECKPOINT_EVERY])
+            due = cursor.fetchall()
+            if not due:
+                continue
+            conn.executemany("""
+            INSERT INTO balance_checkpoints
+            (user_id, ledger_id, timestamp, balance) VALUES (?, ?, ?, ?);
+            """, [(user, changes[user][2], timestamp, balance)
+                  for user, balance in due])
+            conn.executemany("""
+            UPDATE user SET ledger_entries = 0 WHERE id = ?;
+            """, [(user,) for user, _ in due])
 
     def create_transactions(self, sender, receiver, timestamp, amount, message, accepted):
         """
         Create a transaction by sending or requesting money using SQL
         """
-        cursor = self.conn.execute("""
+        return self.write(
+            self.insert_transaction,
+            sender, receiver, timestamp, amount, message, accepted)
+
+    def insert_transaction(self, conn, sender, receiver, timestamp, amount,
+                           message, accepted):
+        """
+        Write for create_transactions
+        """
+        cursor = conn.execute("""
         INSERT INTO transactions (timestamp, sender_id, receiver_id, amount, 
         message, accepted) VALUES (?, ?, ?, ?, ?, ?);
         """, (timestamp, sender, receiver, amount, message, accepted))
-        self.conn.commit()
         return cursor.lastrowid
 
+    def get_balances(self, conn, ids):
+        """
+        Get {id: balance in cents} for the users among `ids` that exist,
+        read on `conn`
+        """
+        ids = list(ids)
+        balances = {}
+        for start in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[start:start + MAX_PARAMETERS]
+            cursor = conn.execute("""
+            SELECT id, balance_cents FROM user WHERE id IN (%s);
+            """ % ", ".join("?" * len(chunk)), chunk)
+            balances.update(cursor)
+        return balances
+
+    def create_transaction_batch(self, transfers, timestamp, atomic=True):
+        """
+        Create many transactions in one transaction using SQL. `transfers`
+        holds (sender, receiver, amount, message, accepted) tuples, and the
+        accepted ones move money in order, each checked against the
+        balances left by those before it. When `atomic` is set a single
+        failure keeps the whole batch out; otherwise only the failures are
+        left out.
+        Returns one result per transfer: the created transaction, the
+        reason it failed (INVALID_AMOUNT, USER_NOT_FOUND or BALANCE_LOW),
+        or None if it was fine but the batch as a whole was not applied.
+        """
+        results, created = self.write(
+            self.insert_transaction_batch, transfers, timestamp, atomic)
+        if created:
+            created = iter(created)
+            results = [next(created) if result is None else result
+                       for result in results]
+        return results
+
+    def insert_transaction_batch(self, conn, transfers, timestamp, atomic):
+        """
+        Write for create_transaction_batch. Returns (results, created
+        transactions), with None for results still to be filled in from
+        the transactions, in order. The transactions are read back as
+        stored, so they match what get_transaction gives later.
+        """
+        balances = self.get_balances(
+            conn, {t[0] for t in transfers} | {t[1] for t in transfers})
+        results = []
+        rows_to_insert = []
+        moved = []
+        for sender, receiver, amount, message, accepted in transfers:
+            # A negative amount would let the sender take money instead
+            if not is_amount(amount) or to_cents(amount) <= 0:
+                results.append(INVALID_AMOUNT)
+                continue
+            if sender not in balances or receiver not in balances:
+                results.append(USER_NOT_FOUND)
+                continue
+            cents = 0
+            if accepted:
+                cents = to_cents(amount)
+                if balances[sender] < cents:
+                    results.append(BALANCE_LOW)
+                    continue
+                balances[sender] -= cents
+                balances[receiver] += cents
+            results.append(None)
+            rows_to_insert.append(
+                (timestamp, sender, receiver, amount, message, accepted))
+            moved.append(cents)
+
+        if not rows_to_insert or (
+                atomic and len(rows_to_insert) < len(transfers)):
+            return results, []
+
+        conn.executemany("""
+        INSERT INTO transactions (timestamp, sender_id, receiver_id,
+        amount, message, accepted) VALUES (?, ?, ?, ?, ?, ?);
+        """, rows_to_insert)
+        # Only the writer thread writes, so the new ids run up to the last
+        # one inserted
+        cursor = conn.execute("SELECT last_insert_rowid();")
+        next_id = cursor.fetchone()[0] - len(rows_to_insert) + 1
+        entries = []
+        for txn_id, row, cents in zip(
+                range(next_id, next_id + len(moved)), rows_to_insert, moved):
+            if cents:
+                entries.append((row[1], -cents, txn_id))
+                entries.append((row[2], cents, txn_id))
+        if entries:
+            self.add_entries(conn, entries)
+        cursor = conn.execute("""
+        SELECT * FROM transactions WHERE id >= ? AND id < ? ORDER BY id;
+        """, (next_id, next_id + len(rows_to_insert)))
+        return results, list(rows.mapped(cursor))
+
     def get_transaction(self, id):
         """
         Get the transaction info given the id using SQL
@@ -214,35 +560,96 @@ class DatabaseDriver(object):
         cursor = self.conn.execute("""
         SELECT * FROM transactions WHERE id = ?; 
         """, (id,))
-        for row in cursor:
-            if (row[6] is None):
-                accepted = None
-            else:
-                accepted = bool(row[6])
-            return {
-                "id": row[0],
-                "timestamp": row[1],
-                "sender_id": row[2],
-                "receiver_id": row[3],
-                "amount": row[4],
-                "message": row[5],
-                "accepted": accepted
-            }
-
-        return None
+        return next(rows.mapped(cursor), None)
 
     def update_transaction(self, id, timestamp, accepted):
         """
         Update the timestamp and accept status for the transaction using SQL
         """
-        self.conn.execute("""
-        UPDATE transactions SET timestamp = ? WHERE id = ?;
-        """, (timestamp, id))
-        self.conn.execute("""
-        UPDATE transactions SET accepted = ? WHERE id = ?;
-        """, (accepted, id))
-        self.conn.commit()
+        self.write(self.set_transaction, id, timestamp, accepted)
+
+    def set_transaction(self, conn, id, timestamp, accepted):
+        """
+        Write for update_transaction
+        """
+        conn.execute("""
+        UPDATE transactions SET timestamp = ?, accepted = ? WHERE id = ?;
+        """, (timestamp, accepted, id))
 
+    def settle_transaction(self, id, accepted, timestamp):
+        """
+        Accept or deny the pending transaction with this id in one
+        transaction using SQL. Only a transaction still pending can be
+        claimed, and an accepted one is only claimed if the sender's
+        balance covers it, so concurrent requests settle it exactly once.
+        Returns (result, transaction) where result is SETTLED,
+        TRANSACTION_NOT_FOUND, ALREADY_SETTLED, BALANCE_LOW or
+        USER_NOT_FOUND and transaction is its current state.
+        """
+        result, txn = self.write(self.settle, id, accepted, timestamp)
+        if result != SETTLED:
+            txn = self.get_transaction(id)
+            if txn is None:
+                return TRANSACTION_NOT_FOUND, None
+        return result, txn
+
+    def settle(self, conn, id, accepted, timestamp):
+        """
+        Write for settle_transaction. Returns (result, transaction), the
+        transaction only being given when it was settled.
+        """
+        txn = self.claim_transaction(conn, id, accepted, timestamp)
+        if txn is None:
+            return ALREADY_SETTLED, None
+
+        if accepted:
+            result = self.move_money(
+                conn, txn["sender_id"], txn["receiver_id"], txn["amount"],
+                id)
+            if result != SETTLED:
+                raise writer.Rollback((result, None))
+        return SETTLED, txn
+
+    def claim_transaction(self, conn, id, accepted, timestamp):
+        """
+        Mark the transaction settled if it is still pending, inside the
+        caller's transaction on `conn`. Returns its new state, or None if
+        it was not pending.
+        """
+        cursor = conn.execute("""
+        UPDATE transactions SET timestamp = ?, accepted = ?
+        WHERE id = ? AND accepted IS NULL%s;
+        """ % (" RETURNING *" if HAS_RETURNING else ""),
+            (timestamp, accepted, id))
+        if HAS_RETURNING:
+            # Read every row so the statement is finished before commit
+            txns = list(rows.mapped(cursor))
+            return txns[0] if txns else None
+        if cursor.rowcount != 1:
+            return None
+        cursor = conn.execute("""
+        SELECT * FROM transactions WHERE id = ?;
+        """, (id,))
+        return next(rows.mapped(cursor), None)
+
+    def move_money(self, conn, sender, receiver, amount, transaction_id):
+        """
+        Move amount from sender to receiver for a transaction, inside the
+        caller's transaction on `conn`. Only the writer thread writes, so
+        the balance read here cannot change before it is taken from.
+        Returns SETTLED, USER_NOT_FOUND or BALANCE_LOW.
+        """
+        cents = to_cents(amount)
+        balances = self.get_balances(conn, {sender, receiver})
+        if len(balances) < len({sender, receiver}):
+            return USER_NOT_FOUND
+        if balances[sender] < cents:
+            return BALANCE_LOW
+        self.add_entries(conn, [
+            (sender, -cents, transaction_id),
+            (receiver, cents, transaction_id)
+        ])
+        return SETTLED
 
 # Only <=1 instance of the database driver
 # exists within the app at all times
@@ -0,0 +1,138 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+
+def optional_bool(value):
+    """
+    SQLite has no booleans, so BOOL columns come back as 0/1 or NULL
+    """
+    return None if value is None else bool(value)
+
+
+# How the values of a column are converted on the way out, by column name
+CONVERTERS = {
+    "accepted": optional_bool,
+}
+
+
+def register_converter(column, convert):
+    """
+    Convert every value read from columns named `column` with `convert`.
+    Only affects mappers made afterwards.
+    """
+    CONVERTERS[column] = convert
+    MAPPERS.clear()
+
+
+def encode_float(value):
+    """
+    Encode a float the way json.dumps does
+    """
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "Infinity" if value > 0 else "-Infinity"
+    return float.__repr__(value)
+
+
+# JSON encoders for the types a converted value may have
+ENCODERS = {
+    type(None): lambda value: "null",
+    bool: lambda value: "true" if value else "false",
+    int: int.__repr__,
+    float: encode_float,
+    str: encode_basestring_ascii,
+}
+
+
+def encode_value(value):
+    """
+    Encode one value as JSON, falling back to json.dumps for unusual types
+    """
+    encode = ENCODERS.get(type(value))
+    if encode is None:
+        return json.dumps(value)
+    return encode(value)
+
+
+class RowMapper(object):
+    """
+    Turns rows with a given list of columns into dictionaries or straight
+    into JSON objects. The keys and converters are worked out once per
+    list of columns rather than once per row.
+    """
+
+    def __init__(self, columns, as_json=False):
+        """
+        Make a mapper for rows of `columns`. With `as_json` each row comes
+        out as the text of a JSON object rather than a dictionary.
+        """
+        self.columns = tuple(columns)
+        self.as_json = as_json
+        self.converters = [
+            (column, CONVERTERS[column])
+            for column in self.columns if column in CONVERTERS]
+        if as_json:
+            self.map = self.json_mapper()
+        else:
+            self.map = self.map_dict
+
+    def json_mapper(self):
+        """
+        Make the function mapping one row to the text of a JSON object. The
+        key of each column is encoded once, up front, along with the
+        encoder for its values.
+        """
+        fields = [
+            (json.dumps(column) + ": ", self.encoder(CONVERTERS.get(column)))
+            for column in self.columns]
+
+        def map_json(row):
+            return "{" + ", ".join([
+                key + encode(value)
+                for (key, encode), value in zip(fields, row)]) + "}"
+
+        return map_json
+
+    @staticmethod
+    def encoder(convert):
+        """
+        Get the function encoding a column's values, converted with
+        `convert` first if there is one
+        """
+        if convert is None:
+            return encode_value
+        return lambda value: encode_value(convert(value))
+
+    def map_dict(self, row):
+        """
+        Map one row to a dictionary
+        """
+        mapped = dict(zip(self.columns, row))
+        for column, convert in self.converters:
+            mapped[column] = convert(mapped[column])
+        return mapped
+
+
+# Mappers made so far, by (columns, as_json)
+MAPPERS = {}
+
+
+def mapper_for(cursor, as_json=False):
+    """
+    Get the mapper for the columns of the query `cursor` has run
+    """
+    columns = tuple(column[0] for column in cursor.description)
+    mapper = MAPPERS.get((columns, as_json))
+    if mapper is None:
+        mapper = MAPPERS[(columns, as_json)] = RowMapper(columns, as_json)
+    return mapper
+
+
+def mapped(cursor, as_json=False):
+    """
+    Iterate over the remaining rows of `cursor` through the mapper for its
+    columns. Mapping plain rows as they are read is cheaper than having
+    the cursor call a row factory for each one.
+    """
+    return map(mapper_for(cursor, as_json).map, cursor)
@@ -0,0 +1,67 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+# The driver opens venmo.db in the working directory on import, so move to
+# a scratch one first. It stays there while the writer thread runs.
+DIRECTORY = tempfile.TemporaryDirectory()
+os.chdir(DIRECTORY.name)
+
+from app import app
+from app import DB
+
+
+class SettleTest(unittest.TestCase):
+    """
+    Concurrent requests to accept one pending transaction settle it, and
+    move its money, exactly once
+    """
+
+    def post(self, url, body, client=None):
+        client = client or app.test_client()
+        response = client.post(url, data=json.dumps(body))
+        return response.status_code, json.loads(response.data)
+
+    def create_user(self, balance):
+        code, user = self.post("/api/users/", {
+            "name": "u", "username": "u", "balance": balance})
+        self.assertEqual(code, 201, user)
+        return user["id"]
+
+    def test_accept_race(self):
+        sender = self.create_user(10)
+        receiver = self.create_user(0)
+        code, txn = self.post("/api/transactions/", {
+            "sender_id": sender, "receiver_id": receiver, "amount": 4,
+            "message": "m"})
+        self.assertEqual(code, 201, txn)
+
+        barrier = threading.Barrier(8)
+        codes = []
+
+        def accept():
+            client = app.test_client()
+            barrier.wait()
+            codes.append(self.post(
+                "/api/transactions/%d/" % txn["id"], {"accepted": True},
+                client)[0])
+
+        threads = [threading.Thread(target=accept) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(codes), [200] + [403] * 7)
+        self.assertEqual(DB.get_balance(sender), 6)
+        self.assertEqual(DB.get_balance(receiver), 4)
+        cursor = DB.conn.execute("""
+        SELECT COUNT(*) FROM ledger WHERE transaction_id = ?;
+        """, (txn["id"],))
+        self.assertEqual(cursor.fetchone()[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
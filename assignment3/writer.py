@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class Rollback(Exception):
+    """
+    Raised by a write to undo its own changes while still handing `value`
+    back to its caller
+    """
+
+    def __init__(self, value=None):
+        super().__init__(value)
+        self.value = value
+
+
+class GroupCommitWriter(object):
+    """
+    Single thread that makes every write to the database. Writes queued
+    while the previous commit was being made are applied together and
+    committed at once, so many writers share one fsync. Each write runs
+    under its own savepoint, so one failing does not undo the others.
+    """
+
+    def __init__(self, connect, delay=0.0, max_batch=1000):
+        """
+        Start the writer on the connection returned by `connect`, which is
+        called on the writer thread and should be in autocommit mode. After
+        the first write of a batch arrives, others are waited for up to
+        `delay` seconds, and at most `max_batch` are committed together.
+        """
+        self.connect = connect
+        self.delay = delay
+        self.max_batch = max_batch
+        self.start()
+
+    def start(self):
+        """
+        Start the writer thread with an empty queue. Call it again in a
+        forked process, which gets a copy of the writer but not its thread.
+        """
+        self.queue = queue.Queue()
+        thread = threading.Thread(
+            target=self.run, args=(self.queue,), daemon=True)
+        thread.start()
+
+    def submit(self, fn, *args):
+        """
+        Queue the write `fn(conn, *args)`. Returns a future for what it
+        returns, which completes once the write has been committed.
+        """
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    def run(self, pending):
+        """
+        Background loop taking batches off the queue and committing them
+        """
+        conn = self.connect()
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(pending.get(timeout=timeout))
+                    else:
+                        batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            self.apply(conn, batch)
+
+    def apply(self, conn, batch):
+        """
+        Make a batch of writes in one transaction, then complete their
+        futures
+        """
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for future, fn, args in batch:
+                conn.execute("SAVEPOINT write;")
+                try:
+                    outcomes.append((future, fn(conn, *args), None))
+                except Rollback as rollback:
+                    conn.execute("ROLLBACK TO write;")
+                    outcomes.append((future, rollback.value, None))
+                except Exception as error:
+                    conn.execute("ROLLBACK TO write;")
+                    outcomes.append((future, None, error))
+                conn.execute("RELEASE write;")
+            conn.execute("COMMIT;")
+        except Exception as error:
+            # The commit itself failed, so none of the batch was made
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            for future, _, _ in batch:
+                future.set_exception(error)
+            return
+
+        for future, value, error in outcomes:
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
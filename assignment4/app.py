@@ -1,15 +1,19 @@
 
 from db import db
+from db import migrate
 from db import Course
 from db import Assignment
 from db import User
+from db import association_table_instructor
+from db import association_table_student
 from flask import Flask
 from flask import request
+from sqlalchemy.exc import IntegrityError
 import json
 import os
 
 app = Flask(__name__)
-db_filename = "cms.db"
+db_filename = os.environ.get("DB_FILENAME", "cms.db")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -18,6 +22,7 @@ app.config["SQLALCHEMY_ECHO"] = True
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    migrate(db.engine)
 
 
 def success_response(data, code=200):
@@ -34,11 +39,13 @@ def failure_response(message, code=404):
     return json.dumps({"error": message}), code
 
 
-def get_course_helper(course_id):
+def get_course_helper(course_id, fields=()):
     """
-    Helper function to get a course by id
+    Helper function to get a course by id, with the relationships among
+    `fields` loaded up front
     """
-    return Course.query.filter_by(id=course_id).first()
+    return Course.query.options(*Course.eager(fields)).filter_by(
+        id=course_id).first()
 
 
 @app.route("/")
@@ -48,15 +55,44 @@ def greeting():
     """
     return os.environ["NETID"] + " was here!"
 
+def get_page_args():
+    """
+    Helper function to read the `limit` and `after_id` of a page. Returns
+    (limit, after_id), or None if they are not valid.
+    """
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        return None
+    return limit, request.args.get("after_id", 0, type=int)
+
+
 @ app.route("/api/courses/")
 def get_courses():
     """
-    Endpoint to get all courses
+    Endpoint to get courses, `limit` at a time from after `after_id`, with
+    only the comma-separated `fields`
     """
+    page = get_page_args()
+    if page is None:
+        return failure_response("Limit must be positive", 400)
+    limit, after_id = page
+    fields = request.args.get("fields")
+    fields = Course.serialized_fields if fields is None else fields.split(",")
+    if not set(fields) <= set(Course.serialized_fields):
+        return failure_response("Unknown field", 400)
+
+    query = Course.query.options(*Course.eager(fields)).filter(
+        Course.id > after_id).order_by(Course.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    found = query.all()
     courses = []
-    for c in Course.query.all():
-        courses.append(c.serialize())
-    return success_response({"courses": courses})
+    for c in found[:limit]:
+        courses.append(c.serialize(fields))
+    res = {"courses": courses}
+    if limit is not None and len(found) > limit:
+        res["next_after_id"] = found[limit - 1].id
+    return success_response(res)
 
 
 @ app.route("/api/courses/", methods=["POST"])
@@ -88,18 +124,57 @@ def get_course(course_id):
     """
     Endpoint to get a specific course by course id
     """
-    course = get_course_helper(course_id)
+    course = get_course_helper(course_id, Course.serialized_relationships)
     if course is None:
         return failure_response("Course not found!")
     return success_response(course.serialize())
 
 
+def get_roster(course_id, table, key):
+    """
+    Helper function to respond with a page of the users of a course in the
+    association `table`, listed under `key`
+    """
+    page = get_page_args()
+    if page is None:
+        return failure_response("Limit must be positive", 400)
+    limit, after_id = page
+    if get_course_helper(course_id) is None:
+        return failure_response("Course not found!")
+
+    users = Course.roster(
+        course_id, table, after_id, None if limit is None else limit + 1)
+    res = {key: [u.serialize_short() for u in users[:limit]]}
+    if limit is not None and len(users) > limit:
+        res["next_after_id"] = users[limit - 1].id
+    return success_response(res)
+
+
+@ app.route("/api/courses/<int:course_id>/students/")
+def get_course_students(course_id):
+    """
+    Endpoint to get the students of a course, `limit` at a time from after
+    `after_id`
+    """
+    return get_roster(course_id, association_table_student, "students")
+
+
+@ app.route("/api/courses/<int:course_id>/instructors/")
+def get_course_instructors(course_id):
+    """
+    Endpoint to get the instructors of a course, `limit` at a time from
+    after `after_id`
+    """
+    return get_roster(
+        course_id, association_table_instructor, "instructors")
+
+
 @ app.route("/api/courses/<int:course_id>/", methods=['DELETE'])
 def delete_course(course_id):
     """
     Endpoint to delete a course by its id
     """
-    course = get_course_helper(course_id)
+    course = get_course_helper(course_id, Course.serialized_relationships)
     if course is None:
         return failure_response("Course not found!")
     db.session.delete(course)
@@ -158,12 +233,21 @@ def add_user_to_course(course_id):
 
     type = body.get('type')
     if type == "student":
-        course.students.append(user)
+        table = association_table_student
     elif type == "instructor":
-        course.instructors.append(user)
+        table = association_table_instructor
     else:
         return failure_response("Type not correct!", 400)
-    db.session.commit()
+
+    # Inserting the row directly leaves the roster unloaded, and its
+    # primary key turns away a second enrollment even from a racing request
+    try:
+        db.session.execute(table.insert().values(
+            course_id=course_id, user_id=user.id))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return failure_response("User already in course!", 400)
     return success_response(course.serialize(), 200)
 
 
@@ -189,7 +273,7 @@ def create_assignment(course_id):
     new_assignment = Assignment(
         title=title,
         due_date=due_date,
-        course=course_id
+        course=course
     )
 
     db.session.add(new_assignment)
@@ -1,16 +1,94 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import selectinload
 
 db = SQLAlchemy()
 
+# Each enrollment is stored once, keyed and clustered by course, with an
+# index to find a user's courses
 association_table_instructor = db.Table("association_instructor", db.Model.metadata,
                                         db.Column("course_id", db.Integer,
-                                                  db.ForeignKey("course.id")),
-                                        db.Column("user_id", db.Integer, db.ForeignKey("user.id")))
+                                                  db.ForeignKey("course.id"), primary_key=True),
+                                        db.Column("user_id", db.Integer, db.ForeignKey(
+                                            "user.id"), primary_key=True),
+                                        db.Index("association_instructor_user", "user_id", "course_id"),
+                                        sqlite_with_rowid=False)
 
 association_table_student = db.Table("association_student", db.Model.metadata,
                                      db.Column("course_id", db.Integer,
-                                               db.ForeignKey("course.id")),
-                                     db.Column("user_id", db.Integer, db.ForeignKey("user.id")))
+                                               db.ForeignKey("course.id"), primary_key=True),
+                                     db.Column("user_id", db.Integer, db.ForeignKey(
+                                         "user.id"), primary_key=True),
+                                     db.Index("association_student_user", "user_id", "course_id"),
+                                     sqlite_with_rowid=False)
+
+
+def rebuild_association_table(name):
+    """
+    Statements rebuilding an association table made before it had a
+    primary key, dropping duplicate and incomplete enrollments
+    """
+    return [
+        """
+        CREATE TABLE %s_new (
+            course_id INTEGER NOT NULL REFERENCES course (id),
+            user_id INTEGER NOT NULL REFERENCES user (id),
+            PRIMARY KEY (course_id, user_id)
+        ) WITHOUT ROWID;
+        """ % name,
+        """
+        INSERT OR IGNORE INTO %s_new (course_id, user_id)
+        SELECT course_id, user_id FROM %s
+        WHERE course_id IS NOT NULL AND user_id IS NOT NULL;
+        """ % (name, name),
+        "DROP TABLE %s;" % name,
+        "ALTER TABLE %s_new RENAME TO %s;" % (name, name),
+        """
+        CREATE INDEX IF NOT EXISTS %s_user ON %s (user_id, course_id);
+        """ % (name, name),
+    ]
+
+
+# Changes to databases made by earlier versions, as (version, statements),
+# oldest first. create_all makes new databases in their current shape, so
+# every statement also has to be harmless on those.
+MIGRATIONS = [
+    (1, rebuild_association_table("association_instructor")
+        + rebuild_association_table("association_student") + [
+        """
+        CREATE INDEX IF NOT EXISTS ix_assignment_course
+        ON assignment (course);
+        """,
+    ]),
+]
+
+
+def migrate(engine):
+    """
+    Run every migration newer than the version recorded in the database.
+    The check and the migrations share one write transaction, so
+    processes starting at the same time run each migration exactly once.
+    """
+    conn = engine.raw_connection()
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL
+            );
+        """)
+        conn.execute("BEGIN IMMEDIATE;")
+        cursor = conn.execute("SELECT MAX(version) FROM schema_version;")
+        version = cursor.fetchone()[0] or 0
+        for number, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("""
+                INSERT INTO schema_version (version) VALUES (?);
+            """, (number,))
+        conn.commit()
+    finally:
+        conn.close()
 
 
 class Course(db.Model):
@@ -18,25 +96,60 @@ class Course(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     code = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
-    assignments = db.relationship("Assignment", cascade="delete")
+    assignments = db.relationship(
+        "Assignment", cascade="delete", back_populates="course")
 
     instructors = db.relationship(
         "User", secondary=association_table_instructor, back_populates="instruct_courses")
     students = db.relationship(
         "User", secondary=association_table_student, back_populates="student_courses")
 
-    def serialize(self):
+    # Fields serialize can give, and those of them that are relationships
+    serialized_fields = ("id", "code", "name",
+                         "assignments", "instructors", "students")
+    serialized_relationships = ("assignments", "instructors", "students")
+
+    @classmethod
+    def eager(cls, fields=serialized_relationships):
         """
-        Serializes information from Course table
+        Loader options fetching the relationships among `fields` along with
+        the courses, one query per relationship however many courses there
+        are, instead of one query per course on first access
         """
-        return {
-            "id": self.id,
-            "code": self.code,
-            "name": self.name,
-            "assignments": [a.serialize_short() for a in self.assignments],
-            "instructors": [i.serialize_short() for i in self.instructors],
-            "students": [s.serialize_short() for s in self.students]
-        }
+        return [selectinload(getattr(cls, field))
+                for field in fields if field in cls.serialized_relationships]
+
+    def serialize(self, fields=serialized_fields):
+        """
+        Serializes information from Course table, only giving `fields`
+        """
+        serialized = {field: value
+                      for field, value in self.serialize_short().items()
+                      if field in fields}
+        if "assignments" in fields:
+            serialized["assignments"] = [
+                a.serialize_short() for a in self.assignments]
+        if "instructors" in fields:
+            serialized["instructors"] = [
+                i.serialize_short() for i in self.instructors]
+        if "students" in fields:
+            serialized["students"] = [
+                s.serialize_short() for s in self.students]
+        return serialized
+
+    @staticmethod
+    def roster(course_id, table, after_id=0, limit=None):
+        """
+        Get up to `limit` users of a course from the association `table`
+        with ids above `after_id`, in id order. The course's rows are read
+        off the table's (course_id, user_id) index from after `after_id`.
+        """
+        query = User.query.join(table, table.c.user_id == User.id).filter(
+            table.c.course_id == course_id, table.c.user_id > after_id
+        ).order_by(table.c.user_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
     def serialize_short(self):
         """
@@ -54,17 +167,21 @@ class Assignment(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String, nullable=False)
     due_date = db.Column(db.BigInteger, nullable=False)
-    course = db.Column(db.Integer, db.ForeignKey("course.id"), nullable=False)
+    # Still stored in the "course" column
+    course_id = db.Column("course", db.Integer,
+                          db.ForeignKey("course.id"), nullable=False, index=True)
+    course = db.relationship("Course", back_populates="assignments")
 
     def serialize(self):
         """
-        Serializes information from the Assignment table
+        Serializes information from the Assignment table. The course is
+        taken from the session when it is already loaded there.
         """
         return {
             "id": self.id,
             "title": self.title,
             "due_date": self.due_date,
-            "course": Course.query.filter_by(id=self.course).first().serialize_short()
+            "course": self.course.serialize_short()
         }
 
     def serialize_short(self):
@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import unittest
+
+# The app opens its database on import, so point it at a scratch one first
+DIRECTORY = tempfile.TemporaryDirectory()
+os.environ["DB_FILENAME"] = os.path.join(DIRECTORY.name, "cms.db")
+
+from app import app
+from db import db
+from db import Course
+from sqlalchemy import event
+
+
+class QueryCountTest(unittest.TestCase):
+    """
+    Serializing is expected to take a fixed number of queries however
+    many related rows there are, rather than one more per row
+    """
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.queries = 0
+        with app.app_context():
+            db.engine.echo = False
+            event.listen(db.engine, "before_cursor_execute", self.count)
+
+    def tearDown(self):
+        with app.app_context():
+            event.remove(db.engine, "before_cursor_execute", self.count)
+            for table in reversed(db.metadata.sorted_tables):
+                db.session.execute(table.delete())
+            db.session.commit()
+
+    def count(self, *args):
+        self.queries += 1
+
+    def post(self, url, body):
+        response = self.client.post(url, data=json.dumps(body))
+        self.assertLess(response.status_code, 300, response.data)
+        return json.loads(response.data)
+
+    def create_course(self, assignments=0):
+        course = self.post("/api/courses/", {"code": "c", "name": "n"})
+        for i in range(assignments):
+            self.post("/api/courses/%d/assignment/" % course["id"],
+                      {"title": "a%d" % i, "due_date": i})
+        return course["id"]
+
+    def serialize_assignments(self, course_id):
+        """
+        Count the queries taken to serialize the assignments of a course
+        """
+        with app.app_context():
+            self.queries = 0
+            course = Course.query.get(course_id)
+            serialized = [a.serialize() for a in course.assignments]
+            for assignment in serialized:
+                self.assertEqual(assignment["course"]["id"], course_id)
+            return self.queries
+
+    def test_assignments(self):
+        one = self.serialize_assignments(self.create_course(1))
+        many = self.serialize_assignments(self.create_course(20))
+        self.assertEqual(one, many)
+
+    def enroll(self, course_id, users):
+        for i in range(users):
+            user = self.post("/api/users/", {"name": "u", "netid": "n%d" % i})
+            self.post("/api/courses/%d/add/" % course_id,
+                      {"user_id": user["id"], "type": "student"})
+            self.post("/api/courses/%d/add/" % course_id,
+                      {"user_id": user["id"], "type": "instructor"})
+
+    def get(self, url):
+        """
+        Count the queries taken to answer a GET of `url`
+        """
+        self.queries = 0
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return self.queries
+
+    def test_courses(self):
+        self.enroll(self.create_course(2), 2)
+        few = self.get("/api/courses/")
+        for _ in range(10):
+            self.enroll(self.create_course(2), 2)
+        self.assertEqual(few, self.get("/api/courses/"))
+
+    def test_course(self):
+        course_id = self.create_course(1)
+        self.enroll(course_id, 1)
+        few = self.get("/api/courses/%d/" % course_id)
+        self.create_course(20)
+        course_id = self.create_course(20)
+        self.enroll(course_id, 10)
+        self.assertEqual(few, self.get("/api/courses/%d/" % course_id))
+
+
+if __name__ == "__main__":
+    unittest.main()